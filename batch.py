@@ -0,0 +1,232 @@
+"""无界面批量分析：数据集只加载一次，按有限并发对一组问题运行与页面相同的分析流程，结果和耗时写入JSONL
+
+    python batch.py sales.xlsx queries.txt --concurrency 8 --rate 2 --out results.jsonl
+    python batch.py big.parquet queries.jsonl --engine duckdb --base-url http://127.0.0.1:8765/v1
+
+问题文件每行一个问题（# 开头的行忽略）；.jsonl 文件每行为 {"id": ..., "query": ...}。
+也可以在代码中调用 load_source() 和 run_batch()。
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from dataset import load_dataset
+from duckdb_backend import duckdb_available, register_file
+from tracing import TRACE_LOG, bind_session
+from utils import AGENT_POOL, stream_dataframe_agent
+
+FILE_TYPES = {".csv": "CSV", ".xlsx": "Excel", ".parquet": "Parquet"}
+# 临时性错误（限流、连接中断、服务端错误）的重试次数和指数退避的初始间隔（秒）
+BATCH_RETRIES = int(os.getenv("BATCH_RETRIES", "3"))
+BATCH_BACKOFF = float(os.getenv("BATCH_BACKOFF", "2"))
+
+
+def read_queries(path):
+    """读取问题文件，返回 [{"id", "query"}, ...]"""
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or (line.startswith("#") and not path.endswith(".jsonl")):
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+                item = item if isinstance(item, dict) else {"query": item}
+                queries.append({"id": item.get("id", number), "query": item["query"]})
+            else:
+                queries.append({"id": number, "query": line})
+    return queries
+
+
+def load_source(path, engine="pandas", sheet_name=None, compact=True):
+    """加载数据集，返回 (数据集键, 数据源)；pandas引擎返回DataFrame，DuckDB引擎返回DuckTable"""
+    file_type = FILE_TYPES.get(os.path.splitext(path)[1].lower())
+    if file_type is None:
+        raise ValueError(f"不支持的文件类型: {path}（支持 {', '.join(FILE_TYPES)}）")
+    if engine == "duckdb":
+        if not duckdb_available():
+            raise RuntimeError("未安装duckdb，无法使用DuckDB引擎")
+        if file_type == "Excel":
+            raise ValueError("DuckDB引擎只支持CSV/Parquet")
+        return register_file(file_type, path=path)
+    if file_type == "Parquet":
+        raise ValueError("Parquet文件请使用 --engine duckdb")
+    with open(path, "rb") as f:
+        data = f.read()
+    return load_dataset(data, file_type, sheet_name if file_type == "Excel" else None,
+                        name=os.path.basename(path), compact=compact)
+
+
+class RateLimiter:
+    """异步令牌桶：限制每秒开始的查询数；接口返回限流时所有任务一起暂停"""
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0.0
+        self._next = 0.0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            wait = max(self._next, self._paused_until) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next = max(self._next, time.monotonic()) + self.interval
+
+
+def _retry_delay(error, attempt):
+    """可重试的错误返回 (等待秒数, 是否限流)，不可重试时返回None；限流时优先使用接口给出的 Retry-After"""
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+        try:
+            return float(retry_after), True
+        except (TypeError, ValueError):
+            return BATCH_BACKOFF * 2 ** (attempt - 1) * (1 + random.random()), True
+    if isinstance(error, (APIConnectionError, InternalServerError)):
+        return BATCH_BACKOFF * 2 ** (attempt - 1) * (1 + random.random()), False
+    return None
+
+
+def _run_query(source, query, dataset_key, base_url, session):
+    # 在线程池中运行；每个查询使用独立的追踪会话，结束后从追踪记录中取出token数和调用次数
+    bind_session(session)
+    steps, result, origin = 0, None, None
+    for event in stream_dataframe_agent(source, query, fingerprint=repr(dataset_key) if dataset_key else None,
+                                        dataset_key=dataset_key, base_url=base_url):
+        if event["type"] == "action":
+            steps += 1
+        elif event["type"] == "result":
+            result, origin = event["result"], event["source"]
+    traces = TRACE_LOG.recent(session, limit=1)
+    attrs = traces[0]["attrs"] if traces else {}
+    return {
+        "result": result,
+        "source": origin,
+        "steps": steps,
+        "llm_calls": attrs.get("llm_calls", 0),
+        "prompt_tokens": attrs.get("prompt_tokens", 0),
+        "completion_tokens": attrs.get("completion_tokens", 0),
+    }
+
+
+async def run_batch(source, queries, dataset_key=None, concurrency=4, rate=None, retries=BATCH_RETRIES,
+                    base_url=None, on_result=None):
+    """并发运行一组问题，返回与 queries 顺序一致的结果记录
+
+    最多 concurrency 个问题同时运行，rate 限制每秒开始的查询数；每个问题完成后调用 on_result(record)。
+    """
+    run_id = uuid.uuid4().hex[:8]
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rate)
+    # 同一数据集的智能体在并发任务之间复用，空闲实例数至少与并发数相同
+    AGENT_POOL.max_idle = max(AGENT_POOL.max_idle, concurrency)
+    submitted = time.perf_counter()
+
+    async def run_one(index, item):
+        async with semaphore:
+            record = {"id": item["id"], "query": item["query"], "status": None, "error": None, "result": None,
+                      "source": None, "attempts": 0, "queued_ms": (time.perf_counter() - submitted) * 1000,
+                      "duration_ms": None, "steps": 0, "llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+            for attempt in range(1, retries + 2):
+                await limiter.acquire()
+                start = time.perf_counter()
+                try:
+                    outcome = await loop.run_in_executor(executor, _run_query, source, item["query"], dataset_key,
+                                                         base_url, f"batch:{run_id}:{index}:{attempt}")
+                    error = None
+                except Exception as e:
+                    outcome, error = {}, e
+                record.update(outcome, attempts=attempt, duration_ms=(time.perf_counter() - start) * 1000,
+                              status="ok" if error is None else "error",
+                              error=None if error is None else f"{type(error).__name__}: {str(error)}")
+                retry = _retry_delay(error, attempt) if error is not None and attempt <= retries else None
+                if retry is None:
+                    break
+                delay, rate_limited = retry
+                if rate_limited:
+                    limiter.pause(delay)
+                print(f"[{item['id']}] {type(error).__name__}，{delay:.1f}秒后重试（第{attempt}次）", file=sys.stderr)
+                await asyncio.sleep(delay)
+        if on_result is not None:
+            on_result(record)
+        return record
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+        return await asyncio.gather(*(run_one(i, item) for i, item in enumerate(queries)))
+
+
+def summarize(records, wall_seconds):
+    ok = [r for r in records if r["status"] == "ok"]
+    durations = [r["duration_ms"] for r in ok]
+    summary = {
+        "queries": len(records),
+        "ok": len(ok),
+        "failed": len(records) - len(ok),
+        "wall_s": wall_seconds,
+        "queries_per_min": len(records) / wall_seconds * 60 if wall_seconds else None,
+        "p50_ms": float(np.percentile(durations, 50)) if durations else None,
+        "p95_ms": float(np.percentile(durations, 95)) if durations else None,
+        "sources": {s: sum(1 for r in ok if r["source"] == s) for s in ("cache", "planner", "agent")},
+        "prompt_tokens": sum(r.get("prompt_tokens", 0) for r in ok),
+        "completion_tokens": sum(r.get("completion_tokens", 0) for r in ok),
+    }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量运行数据分析问题，结果写入JSONL")
+    parser.add_argument("dataset", help="数据文件路径（.csv / .xlsx / .parquet）")
+    parser.add_argument("queries", help="问题文件：每行一个问题，或每行 {\"id\", \"query\"} 的 .jsonl")
+    parser.add_argument("--out", default="batch_results.jsonl", help="结果文件（JSONL），每完成一个问题追加一行")
+    parser.add_argument("--engine", choices=["pandas", "duckdb"], default="pandas")
+    parser.add_argument("--sheet", help="Excel工作表名称，默认第一个")
+    parser.add_argument("--no-compact", action="store_true", help="加载时不压缩数据类型")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时运行的问题数")
+    parser.add_argument("--rate", type=float, help="每秒最多开始的问题数，默认不限制")
+    parser.add_argument("--retries", type=int, default=BATCH_RETRIES, help="限流/连接错误的重试次数")
+    parser.add_argument("--base-url", help="OpenAI兼容接口地址，默认使用 OPENAI_BASE_URL")
+    parser.add_argument("--verbose", action="store_true", help="输出智能体的详细日志（并发时会交错）")
+    args = parser.parse_args()
+
+    queries = read_queries(args.queries)
+    start = time.perf_counter()
+    dataset_key, source = load_source(args.dataset, args.engine, args.sheet, compact=not args.no_compact)
+    print(f"已加载数据集（{time.perf_counter() - start:.1f}秒），共 {len(queries)} 个问题", file=sys.stderr)
+
+    done = 0
+    with open(args.out, "w", encoding="utf-8") as out:
+        def on_result(record):
+            nonlocal done
+            done += 1
+            out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            out.flush()
+            print(f"[{done}/{len(queries)}] #{record['id']} {record['status']} "
+                  f"{record['duration_ms']:.0f} ms {record.get('source') or record['error']}", file=sys.stderr)
+
+        # 智能体的详细日志直接打印到标准输出，默认丢弃
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            start = time.perf_counter()
+            records = asyncio.run(run_batch(source, queries, dataset_key, args.concurrency, args.rate,
+                                            args.retries, args.base_url, on_result))
+    summary = summarize(records, time.perf_counter() - start)
+    print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
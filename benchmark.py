@@ -0,0 +1,210 @@
+"""端到端基准测试：数据加载、分析智能体往返、各类图表生成和聊天，报告 p50/p95 延迟和峰值内存
+
+默认在本地启动 mock_server.py 模拟接口，不访问外部服务：
+    python benchmark.py --rows 10000 100000 1000000 --repeat 5 --out bench.json
+    python benchmark.py --compare bench.json          # 与之前保存的结果对比
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+# 缓存和列式存储放到临时目录，既不污染工作目录，也保证每次测到的是冷路径
+_WORKDIR = tempfile.mkdtemp(prefix="bench-")
+os.environ.setdefault("QUERY_CACHE_PATH", os.path.join(_WORKDIR, "query_cache.sqlite3"))
+os.environ.setdefault("DATASET_STORE_DIR", os.path.join(_WORKDIR, "dataset_store"))
+os.environ.setdefault("DUCKDB_DIR", os.path.join(_WORKDIR, "duckdb_store"))
+os.environ.setdefault("TRACE_LOG_PATH", os.path.join(_WORKDIR, "trace_log.jsonl"))
+
+import numpy as np
+import pandas as pd
+
+from charts import render_chart
+from dataset import parse_upload
+from mock_server import start_server
+from tracing import max_rss_bytes
+from utils import build_chat_memory, dataframe_agent, get_chat_model, stream_chat_reply
+
+CHART_TYPES = ["柱状图", "折线图", "散点图", "饼图"]
+# openpyxl 单个工作表最多 1,048,576 行，超过的规模跳过Excel加载测试
+EXCEL_MAX_ROWS = 1048575
+
+
+def make_frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "date": pd.date_range("2020-01-01", periods=rows, freq="min"),
+        "region": rng.choice(["华东", "华南", "华北", "西南", "西北"], rows),
+        "product": rng.choice([f"P{i:03d}" for i in range(200)], rows),
+        "sales": rng.gamma(2.0, 50.0, rows).round(2),
+        "qty": rng.integers(1, 100, rows),
+    })
+
+
+def to_excel_bytes(df):
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def measure(name, fn, repeat, warmup=1):
+    """先预热，再计时 repeat 次；另外单独跑一次 tracemalloc 统计峰值内存（不计入延迟）"""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    rss = max_rss_bytes()
+    result = {
+        "name": name,
+        "runs": repeat,
+        "p50_ms": float(np.percentile(timings, 50) * 1000),
+        "p95_ms": float(np.percentile(timings, 95) * 1000),
+        "mean_ms": float(np.mean(timings) * 1000),
+        "peak_alloc_mb": peak / 1024 / 1024,
+        "max_rss_mb": rss / 1024 / 1024 if rss is not None else None,
+    }
+    print(f"{name:<36} p50 {result['p50_ms']:>10.1f} ms   p95 {result['p95_ms']:>10.1f} ms   "
+          f"peak {result['peak_alloc_mb']:>8.1f} MB", flush=True)
+    return result
+
+
+def bench_ingest(rows_list, repeat, compact):
+    results = []
+    for rows in rows_list:
+        df = make_frame(rows)
+        csv_data = df.to_csv(index=False).encode()
+        results.append(measure(f"ingest/csv/{rows}", lambda: parse_upload(csv_data, "CSV", compact=compact), repeat))
+        if rows <= EXCEL_MAX_ROWS:
+            excel_data = to_excel_bytes(df)
+            results.append(measure(f"ingest/excel/{rows}",
+                                   lambda: parse_upload(excel_data, "Excel", compact=compact), repeat))
+    return results
+
+
+def bench_charts(rows_list, repeat):
+    results = []
+    for rows in rows_list:
+        df = make_frame(rows)
+        for chart_type in CHART_TYPES:
+            spec = {
+                "chart_type": chart_type,
+                "x_col": "qty" if chart_type == "散点图" else "region",
+                "y_cols": ["sales"],
+                "hue_col": None,
+                "x_label": "", "y_label": "",
+                "agg": "mean", "ci": chart_type == "柱状图", "max_points": 5000, "bin_mode": "hex",
+            }
+            # 不传数据集键，跳过聚合和图片缓存
+            results.append(measure(f"chart/{chart_type}/{rows}", lambda: render_chart(df, spec), repeat))
+    return results
+
+
+def bench_agent(rows, repeat, base_url):
+    df = make_frame(rows)
+    counter = iter(range(10 ** 9))
+
+    def run():
+        # 每次使用不同的问题，避开结果缓存和快速通道，测量完整的智能体往返；不输出智能体的详细日志
+        with contextlib.redirect_stdout(io.StringIO()):
+            dataframe_agent(df, f"请分析这份数据的整体情况并给出结论（基准测试 #{next(counter)}）",
+                            fingerprint=f"bench-{rows}", base_url=base_url)
+
+    return [measure(f"agent/round_trip/{rows}", run, repeat)]
+
+
+def bench_chat(repeat, base_url):
+    model = get_chat_model("bench", base_url, "gpt-4")
+    memory = build_chat_memory(get_chat_model("bench", base_url, "gpt-4o-mini", temperature=0))
+
+    def run():
+        for _ in stream_chat_reply(model, memory, "介绍一下你自己"):
+            pass
+
+    return [measure("chat/turn", run, repeat)]
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(previous, current):
+    """按用例名对比两次结果的 p50/p95 变化"""
+    before = {r["name"]: r for r in previous["results"]}
+    print(f"\n对比 {previous.get('revision')} → {current.get('revision')}")
+    for result in current["results"]:
+        old = before.get(result["name"])
+        if not old:
+            continue
+        changes = [f"{key[:3]} {(result[key] / old[key] - 1) * 100:+6.1f}%"
+                   for key in ("p50_ms", "p95_ms") if old[key]]
+        print(f"{result['name']:<36} " + "   ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="智能数据分析平台端到端基准测试")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="数据规模（行数），可指定多个，如 10000 100000 1000000 10000000")
+    parser.add_argument("--suites", nargs="+", default=["ingest", "agent", "chart", "chat"],
+                        choices=["ingest", "agent", "chart", "chat"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--no-compact", action="store_true", help="加载时不压缩数据类型")
+    parser.add_argument("--base-url", help="使用已有的接口地址，不启动本地模拟接口")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟接口每个请求的延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="模拟接口流式片段间隔（秒）")
+    parser.add_argument("--out", help="把结果保存为JSON，便于版本之间对比")
+    parser.add_argument("--compare", help="与之前保存的JSON结果对比")
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if base_url is None and ({"agent", "chat"} & set(args.suites)):
+        _, base_url = start_server(latency=args.latency, token_delay=args.token_delay)
+
+    results = []
+    if "ingest" in args.suites:
+        results += bench_ingest(args.rows, args.repeat, compact=not args.no_compact)
+    if "chart" in args.suites:
+        results += bench_charts(args.rows, args.repeat)
+    if "agent" in args.suites:
+        results += bench_agent(min(args.rows), args.repeat, base_url)
+    if "chat" in args.suites:
+        results += bench_chat(args.repeat, base_url)
+
+    report = {
+        "revision": _git_revision(),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
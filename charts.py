@@ -0,0 +1,315 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import seaborn as sns
+from matplotlib import rc_context, style
+from matplotlib.figure import Figure
+
+from dataset import LRUCache, load_columns
+from duckdb_backend import DuckTable
+from tracing import register_cache, span
+
+# 聚合结果缓存的内存预算（MB）
+AGG_CACHE_MB = int(os.getenv("AGG_CACHE_MB", "128"))
+AGG_CACHE = register_cache("aggregate", LRUCache(AGG_CACHE_MB * 1024 * 1024))
+
+# 点数超过该阈值时自动降采样：折线用LTTB，散点用二维分箱
+DOWNSAMPLE_THRESHOLD = int(os.getenv("DOWNSAMPLE_THRESHOLD", "5000"))
+# 分类X轴最多标注的刻度数
+MAX_CATEGORY_TICKS = 30
+
+# 渲染结果（PNG/SVG字节）缓存的内存预算（MB）
+CHART_CACHE_MB = int(os.getenv("CHART_CACHE_MB", "64"))
+CHART_CACHE = register_cache("chart", LRUCache(CHART_CACHE_MB * 1024 * 1024,
+                                                sizeof=lambda chart: len(chart["image"])))
+
+# seaborn风格 + 中文字体（SimHei）+ 负号正常显示；只在渲染期间通过 rc_context 生效
+CHART_STYLE = dict(style.library['seaborn-v0_8'], **{'font.sans-serif': ['SimHei'], 'axes.unicode_minus': False})
+
+AGG_FUNCS = {"平均值": "mean", "求和": "sum", "计数": "count"}
+SCATTER_BIN_MODES = {"六边形分箱": "hex", "网格分箱": "grid"}
+# 95%置信区间的正态分位数
+CI_Z = 1.959963984540054
+
+
+def aggregate(df, x_col, y_cols, hue_col=None, agg="mean", ci=False):
+    """向量化分组聚合，返回长表：x_col, [hue_col], variable, value, [lower, upper]
+
+    ci=True 时用解析公式计算95%置信区间（均值：z·s/√n，求和：z·s·√n），不做bootstrap重采样。
+    """
+    keys = [x_col] + ([hue_col] if hue_col and hue_col != x_col else [])
+    with_ci = ci and agg in ("mean", "sum")
+    if isinstance(df, DuckTable):
+        # DuckDB引擎：分组聚合下推到DuckDB执行，只取回聚合结果
+        result = df.group_stats(keys, list(y_cols), agg, with_spread=with_ci)
+        if with_ci:
+            std, n = result.pop("std").to_numpy(), result.pop("n").to_numpy()
+    else:
+        grouped = df.groupby(keys, observed=True, sort=True)[list(y_cols)]
+
+        def to_long(frame, name):
+            return frame.reset_index().melt(id_vars=keys, var_name="variable", value_name=name)
+
+        result = to_long(grouped.agg(agg), "value")
+        if with_ci:
+            std = to_long(grouped.std(), "std")["std"].to_numpy()
+            n = to_long(grouped.count(), "n")["n"].to_numpy()
+    if with_ci:
+        se = std / np.sqrt(n) if agg == "mean" else std * np.sqrt(n)
+        # 单个样本的组没有方差估计，区间退化为点
+        half = np.nan_to_num(CI_Z * se)
+        result["lower"] = result["value"] - half
+        result["upper"] = result["value"] + half
+    return result
+
+
+def cached_aggregate(dataset_key, df, x_col, y_cols, hue_col=None, agg="mean", ci=False):
+    # 相同数据集和图表参数的聚合结果在所有会话之间复用
+    with span("aggregate", agg=agg, ci=ci):
+        if dataset_key is None:
+            return aggregate(df, x_col, y_cols, hue_col, agg, ci)
+        key = (dataset_key, x_col, tuple(y_cols), hue_col, agg, ci)
+        return AGG_CACHE.get_or_load(key, lambda: aggregate(df, x_col, y_cols, hue_col, agg, ci))
+
+
+def _series_labels(agg_df, hue_col, y_cols):
+    if not hue_col:
+        return agg_df["variable"].astype(str)
+    if len(y_cols) == 1:
+        return agg_df[hue_col].astype(str)
+    return agg_df["variable"].astype(str) + " / " + agg_df[hue_col].astype(str)
+
+
+def _pivot(agg_df, x_col, hue_col, y_cols, values):
+    frame = agg_df.assign(series=_series_labels(agg_df, hue_col, y_cols))
+    pivot = frame.pivot(index=x_col, columns="series", values=values)
+    pivot.columns.name = hue_col
+    return pivot
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets 降采样，返回保留点的下标（首尾点始终保留）"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    # 第 i 个桶覆盖 [edges[i], edges[i+1])，首尾点各自单独成桶
+    edges = (np.arange(threshold - 1) * (n - 2) / (threshold - 2)).astype(np.int64) + 1
+    edges[-1] = n - 1
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        # 以上一个选中点和下一个桶的均值点为底，选三角形面积最大的点
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def _numeric_positions(index):
+    if pd.api.types.is_datetime64_any_dtype(index):
+        return index, index.asi8.astype("float64")
+    if pd.api.types.is_numeric_dtype(index):
+        return index, index.to_numpy(dtype="float64")
+    positions = np.arange(len(index))
+    return positions, positions.astype("float64")
+
+
+def plot_aggregated(ax, agg_df, x_col, y_cols, hue_col=None, kind="bar", max_points=DOWNSAMPLE_THRESHOLD):
+    """只绘制聚合后的点；包含 lower/upper 列时画误差线（柱状图）或置信带（折线图）
+
+    折线中单条序列的点数超过 max_points 时用LTTB降采样。返回实际绘制的点数。
+    """
+    values = _pivot(agg_df, x_col, hue_col, y_cols, "value")
+    has_ci = "lower" in agg_df.columns
+    errors = (values - _pivot(agg_df, x_col, hue_col, y_cols, "lower")) if has_ci else None
+    show_legend = len(values.columns) > 1
+
+    if kind == "bar":
+        values.index = values.index.astype(str)
+        values.plot(kind="bar", ax=ax, yerr=errors, capsize=3, legend=show_legend,
+                    color=sns.color_palette("Blues_d", len(values.columns)))
+        return int(values.notna().sum().sum())
+
+    # 折线图：数值/日期型X按实际取值绘制，分类X按位置绘制并标注刻度
+    positions, numeric_x = _numeric_positions(values.index)
+    if not (pd.api.types.is_numeric_dtype(values.index) or pd.api.types.is_datetime64_any_dtype(values.index)):
+        step = max(1, int(np.ceil(len(values) / MAX_CATEGORY_TICKS)))
+        ax.set_xticks(positions[::step])
+        ax.set_xticklabels(values.index.astype(str)[::step])
+
+    shown = 0
+    for series in values.columns:
+        valid = values[series].notna().to_numpy()
+        keep = np.flatnonzero(valid)[lttb(numeric_x[valid], values[series].to_numpy()[valid], max_points)]
+        xs, ys = positions[keep], values[series].to_numpy()[keep]
+        ax.plot(xs, ys, marker="o" if len(keep) <= 200 else None, linewidth=2.5 if len(keep) <= 200 else 1.2,
+                label=str(series))
+        if has_ci:
+            err = errors[series].to_numpy()[keep]
+            ax.fill_between(xs, ys - err, ys + err, alpha=0.2)
+        shown += len(keep)
+    if show_legend:
+        ax.legend(title=hue_col)
+    return shown
+
+
+def plot_scatter(ax, df, x_col, y_col, max_points=DOWNSAMPLE_THRESHOLD, mode="hex"):
+    """点数不超过 max_points 时直接画散点，否则做向量化二维分箱。返回 (绘制的点数/非空分箱数, 是否分箱)
+
+    DuckDB表只取回不超过 max_points 的点；点数更多时在DuckDB中做网格分箱（六边形分箱无法下推）。
+    """
+    if isinstance(df, DuckTable):
+        data = df.project([x_col, y_col], limit=max_points + 1, dropna=True)
+        if len(data) > max_points:
+            return _draw_grid(ax, *df.histogram2d(x_col, y_col, bins=200)), True
+    else:
+        data = df[[x_col, y_col]].dropna()
+    x = data[x_col].to_numpy(dtype="float64")
+    y = data[y_col].to_numpy(dtype="float64")
+    if len(x) <= max_points:
+        ax.scatter(x, y, s=100 if len(x) <= 1000 else 20, color="#4a6baf", edgecolors="white", linewidths=0.5)
+        return len(x), False
+
+    if mode == "hex":
+        collection = ax.hexbin(x, y, gridsize=80, cmap="Blues", mincnt=1)
+        ax.figure.colorbar(collection, ax=ax, label="点数")
+        return len(collection.get_array()), True
+
+    return _draw_grid(ax, *np.histogram2d(x, y, bins=200)), True
+
+
+def _draw_grid(ax, counts, x_edges, y_edges):
+    counts = np.ma.masked_equal(counts.T, 0)
+    mesh = ax.pcolormesh(x_edges, y_edges, counts, cmap="Blues")
+    ax.figure.colorbar(mesh, ax=ax, label="点数")
+    return int(counts.count())
+
+
+def _draw_chart(ax, data, spec, dataset_key):
+    chart_type, x_col, y_cols, hue_col = spec["chart_type"], spec["x_col"], list(spec["y_cols"]), spec["hue_col"]
+    max_points = spec.get("max_points", DOWNSAMPLE_THRESHOLD)
+    shown_points, binned, warnings = None, False, []
+
+    ax.grid(True, linestyle='--', alpha=0.3)
+
+    # 柱状图 / 折线图：先分组聚合，只绘制聚合后的点
+    if chart_type in ["柱状图", "折线图"] and x_col and y_cols:
+        agg_df = cached_aggregate(dataset_key, data, x_col, y_cols, hue_col,
+                                  agg=spec.get("agg", "mean"), ci=spec.get("ci", False))
+        shown_points = plot_aggregated(ax, agg_df, x_col, y_cols, hue_col,
+                                       kind="bar" if chart_type == "柱状图" else "line",
+                                       max_points=max_points)
+
+    # 散点图
+    elif chart_type == "散点图" and x_col and y_cols:
+        # 确保使用数值列
+        if not pd.api.types.is_numeric_dtype(data.dtypes[x_col]):
+            warnings.append("散点图X轴需要数值数据")
+        else:
+            shown_points, binned = plot_scatter(ax, data, x_col, y_cols[0], max_points=max_points,
+                                                mode=spec.get("bin_mode") or "hex")
+            ax.set_ylabel(y_cols[0])
+
+    # 饼图
+    elif chart_type == "饼图" and x_col and len(y_cols) == 1:
+        plot_df = cached_aggregate(dataset_key, data, x_col, y_cols, agg="sum")
+        plot_df = plot_df.set_index(plot_df[x_col].astype(str))['value']
+
+        # 过滤掉空值
+        plot_df = plot_df[plot_df > 0]
+
+        if len(plot_df) > 0:
+            plot_df.plot(kind='pie',
+                         autopct='%1.1f%%',
+                         ax=ax,
+                         colors=sns.color_palette("Blues", len(plot_df)),
+                         startangle=90,
+                         ylabel="")
+            ax.set_ylabel("")
+        else:
+            warnings.append("没有有效数据生成饼图")
+
+    # 设置图表标题和标签
+    if x_col and y_cols:
+        title = f"{chart_type}: {x_col} vs {', '.join(y_cols)}"
+        if hue_col:
+            title += f" (按 {hue_col} 分组)"
+        ax.set_title(title, fontsize=14)
+
+        # 设置X轴和Y轴标签（饼图除外）
+        if chart_type != "饼图":
+            ax.set_xlabel(spec.get("x_label", x_col), fontsize=12, fontweight='bold', labelpad=10)
+            ax.set_ylabel(spec.get("y_label", ""), fontsize=12, fontweight='bold', labelpad=10)
+            ax.xaxis.label.set_color('#333')
+            ax.yaxis.label.set_color('#333')
+
+    # 美化图表
+    for label in ax.get_xticklabels():
+        label.set(rotation=45, ha='right')
+    ax.figure.tight_layout()
+
+    return shown_points, binned, warnings
+
+
+def render_chart(data, spec, dataset_key=None, fmt="png"):
+    """按图表规格绘图并栅格化为字节
+
+    直接创建 Figure 而不经过 pyplot，不登记到全局的figure管理器，后台线程并发渲染互不影响，用完即被回收。
+
+    spec 包含 chart_type, x_col, y_cols, hue_col, x_label, y_label, agg, ci, max_points, bin_mode。
+    返回 {"image", "format", "shown_points", "total_rows", "binned", "warnings"}。
+    """
+    with rc_context(CHART_STYLE):
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
+        with span("plot", chart_type=spec["chart_type"]):
+            shown_points, binned, warnings = _draw_chart(ax, data, spec, dataset_key)
+        buffer = io.BytesIO()
+        with span("rasterize", format=fmt) as attrs:
+            fig.savefig(buffer, format=fmt, dpi=100)
+            attrs["image_bytes"] = buffer.tell()
+
+    return {
+        "image": buffer.getvalue(),
+        "format": fmt,
+        "shown_points": shown_points,
+        "total_rows": len(data),
+        "binned": binned,
+        "warnings": warnings,
+    }
+
+
+def chart_cache_key(dataset_key, spec, fmt="png"):
+    return (dataset_key, fmt) + tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else value) for name, value in spec.items()
+    ))
+
+
+def cached_render_chart(dataset_key, load_data, spec, fmt="png"):
+    """相同数据集和图表规格直接返回已渲染的图片字节；load_data 只在未命中时调用"""
+    if dataset_key is None:
+        return render_chart(load_data(), spec, fmt=fmt)
+    return CHART_CACHE.get_or_load(chart_cache_key(dataset_key, spec, fmt),
+                                   lambda: render_chart(load_data(), spec, dataset_key, fmt))
+
+
+def chart_columns(spec):
+    return list(dict.fromkeys([spec["x_col"]] + list(spec["y_cols"]) + ([spec["hue_col"]] if spec["hue_col"] else [])))
+
+
+def render_chart_job(dataset_key, spec, data=None):
+    """在后台进程中渲染图表；数据集已落盘时只按列内存映射读取，不跨进程传输整表"""
+    if data is None:
+        data = load_columns(dataset_key, chart_columns(spec))
+    return render_chart(data, spec, dataset_key)
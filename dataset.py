@@ -0,0 +1,571 @@
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+import openpyxl
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from tracing import register_cache, span
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# 数据集缓存的内存预算（MB），可通过环境变量调整
+DATASET_CACHE_MB = int(os.getenv("DATASET_CACHE_MB", "1024"))
+# 后台预解析其余工作表的线程数和单个文件最多预解析的工作表数
+SHEET_PREFETCH_WORKERS = int(os.getenv("SHEET_PREFETCH_WORKERS", "1"))
+SHEET_PREFETCH_MAX = int(os.getenv("SHEET_PREFETCH_MAX", "10"))
+# 记住最近多少个已预取的上传，避免每次页面重跑都重新提交预取
+SHEET_PREFETCH_HISTORY = 256
+# 流式读取Excel时每批构建的行数
+EXCEL_CHUNK_ROWS = 50000
+# 紧凑加载：CSV分块行数；唯一值占比不超过该值的字符串列转为category
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "200000"))
+CATEGORY_MAX_RATIO = 0.5
+# 列式数据集存储目录（Arrow IPC文件 + registry.json）
+DATASET_STORE_DIR = os.getenv("DATASET_STORE_DIR", ".dataset_store")
+# 派生列（类型转换、小写化等）缓存的内存预算（MB），与数据集缓存分开计算
+DERIVED_CACHE_MB = int(os.getenv("DERIVED_CACHE_MB", "256"))
+# 会话超过该时间（秒）没有任何操作时不再算作数据集的引用者（Streamlit没有会话结束的回调）
+SESSION_IDLE_SECONDS = int(os.getenv("SESSION_IDLE_SECONDS", "3600"))
+
+# pandas 3 默认写时复制；pandas 2 需要显式打开，各会话拿到的视图被修改时才不会改动共享的数据
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+_DATE_PATTERN = re.compile(r"^\s*(\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.]\d{4})")
+
+_XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+
+
+def file_hash(data):
+    # 按文件内容计算哈希，同一文件无论文件名/会话都得到相同的键
+    return hashlib.sha256(data).hexdigest()
+
+
+def frame_nbytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+        n /= 1024
+
+
+class LRUCache:
+    """按字节预算做LRU淘汰的线程安全缓存，模块级实例在所有会话之间共享
+
+    pinned(key) 返回True的条目（如仍被会话引用的数据集）不会被淘汰。
+    """
+
+    def __init__(self, max_bytes, sizeof=frame_nbytes, pinned=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.pinned = pinned
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._sizes.pop(key)
+                del self._data[key]
+            # 单个条目超过预算时不缓存，避免把其他条目全部挤出
+            if size > self.max_bytes:
+                return value
+            self._data[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            self._evict(keep=key)
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._bytes -= self._sizes.pop(key)
+            return self._data.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        # 同一个键只解析一次：并发会话等待第一个会话的解析结果
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                value = self._data.get(key)
+            if value is None:
+                value = self.put(key, loader())
+        with self._lock:
+            self._loading.pop(key, None)
+        return value
+
+    def trim(self):
+        """引用关系变化后重新检查预算，淘汰不再被引用的条目"""
+        with self._lock:
+            self._evict()
+
+    def _evict(self, keep=None):
+        # 从最久未使用的开始淘汰，跳过被引用的条目和刚放入的条目
+        for old_key in list(self._data):
+            if self._bytes <= self.max_bytes:
+                break
+            if old_key == keep or (self.pinned is not None and self.pinned(old_key)):
+                continue
+            del self._data[old_key]
+            self._bytes -= self._sizes.pop(old_key)
+
+
+class DatasetRegistry:
+    """记录每个会话当前使用的数据集（引用计数）
+
+    被引用的数据集不会从数据集缓存中淘汰，所有会话共享同一份只读数据；会话切换数据集、加载失败
+    或长时间没有操作后引用失效，超出内存预算的数据集随之淘汰。
+    """
+
+    def __init__(self, idle_seconds):
+        self.idle_seconds = idle_seconds
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def bind(self, session_id, key):
+        with self._lock:
+            self._sessions[session_id] = (key, time.time())
+
+    def touch(self, session_id):
+        with self._lock:
+            if session_id in self._sessions:
+                self._sessions[session_id] = (self._sessions[session_id][0], time.time())
+
+    def release(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _expire(self):
+        cutoff = time.time() - self.idle_seconds
+        for session_id in [s for s, (_, seen) in self._sessions.items() if seen < cutoff]:
+            del self._sessions[session_id]
+
+    def refcount(self, key):
+        with self._lock:
+            self._expire()
+            return sum(1 for bound, _ in self._sessions.values() if bound == key)
+
+    def is_referenced(self, key):
+        return self.refcount(key) > 0
+
+    def referenced_keys(self):
+        with self._lock:
+            self._expire()
+            return {key for key, _ in self._sessions.values()}
+
+
+DATASET_REGISTRY = DatasetRegistry(SESSION_IDLE_SECONDS)
+DATASET_CACHE = register_cache("dataset", LRUCache(DATASET_CACHE_MB * 1024 * 1024,
+                                                   pinned=DATASET_REGISTRY.is_referenced))
+DERIVED_CACHE = register_cache("derived", LRUCache(DERIVED_CACHE_MB * 1024 * 1024,
+                                                   sizeof=lambda series: int(series.memory_usage(deep=True))))
+SHEET_NAMES_CACHE = register_cache("sheet_names", LRUCache(256, sizeof=lambda names: 1))
+
+
+def dataset_key(content_hash, sheet_name=None, **options):
+    # 缓存键 = 文件内容哈希 + 工作表 + 解析参数
+    return content_hash, sheet_name, tuple(sorted(options.items()))
+
+
+def _probe_sheet_names(data):
+    # 只读取压缩包中的 xl/workbook.xml，不解析任何单元格
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            root = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+        return [sheet.get("name") for sheet in root.iter(f"{_XLSX_NS}sheet")]
+    except (KeyError, zipfile.BadZipFile, ElementTree.ParseError):
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+        try:
+            return wb.sheetnames
+        finally:
+            wb.close()
+
+
+def excel_sheet_names(data, content_hash=None):
+    content_hash = content_hash or file_hash(data)
+    with span("sheet_names"):
+        return SHEET_NAMES_CACHE.get_or_load(content_hash, lambda: _probe_sheet_names(data))
+
+
+def _header_names(header):
+    # 与 pd.read_excel 保持一致：空表头命名为 "Unnamed: i"，重名列追加 ".1"、".2"
+    names, seen = [], {}
+    for i, name in enumerate(header):
+        name = f"Unnamed: {i}" if name is None else name
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def read_excel_sheet(data, sheet_name=None):
+    """以只读模式逐行流式读取单个工作表，分批构建DataFrame，不加载整个工作簿对象模型"""
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        ws = wb[sheet_name] if sheet_name is not None else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame()
+
+        width = len(header)
+        chunks, batch, pending_blank = [], [], 0
+        for row in rows:
+            # 连续空行先暂存，只有后面还有数据时才保留，从而丢弃表尾空行
+            if all(value is None for value in row):
+                pending_blank += 1
+                continue
+            batch.extend([(None,) * width] * pending_blank)
+            pending_blank = 0
+            batch.append(tuple(row[:width]) + (None,) * (width - len(row)))
+            if len(batch) >= EXCEL_CHUNK_ROWS:
+                chunks.append(pd.DataFrame.from_records(batch, columns=range(width)))
+                batch = []
+        if batch or not chunks:
+            chunks.append(pd.DataFrame.from_records(batch, columns=range(width)))
+    finally:
+        wb.close()
+
+    df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    df.columns = _header_names(header)
+    # 去掉没有表头且全为空的尾部列
+    while len(df.columns) and header[len(df.columns) - 1] is None and df.iloc[:, -1].isna().all():
+        df = df.iloc[:, :-1]
+    return df.infer_objects()
+
+
+def _is_text(series):
+    return pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+
+
+def _plan_columns(sample):
+    # 根据第一个分块决定每个字符串列的目标类型，后续分块沿用同一方案；
+    # 数值列保持int64/float64不降位宽，智能体生成的算术（求和、相乘）不会因位宽不足而溢出或丢精度
+    plan = {}
+    for col in sample.columns:
+        series = sample[col]
+        if not _is_text(series):
+            continue
+        values = series.dropna()
+        if len(values) and values.head(200).astype(str).str.match(_DATE_PATTERN).all():
+            plan[col] = "datetime"
+        elif len(values) and values.nunique() / len(values) <= CATEGORY_MAX_RATIO:
+            plan[col] = "category"
+    return plan
+
+
+def _apply_plan(df, plan):
+    df = df.copy()
+    for col in df.columns:
+        kind = plan.get(col)
+        if kind == "datetime":
+            parsed = pd.to_datetime(df[col], errors="coerce")
+            # 解析失败会丢失数据时保留原始字符串
+            if parsed.notna().sum() == df[col].notna().sum():
+                df[col] = parsed
+        elif kind == "category":
+            df[col] = df[col].astype("category")
+    return df
+
+
+def compact_frame(df):
+    """压缩单个DataFrame的数据类型，并在 attrs 中记录压缩前后的内存占用"""
+    before = frame_nbytes(df)
+    df = _apply_plan(df, _plan_columns(df))
+    df.attrs["memory_report"] = {"before": before, "after": frame_nbytes(df)}
+    return df
+
+
+def read_csv_compact(data, chunksize=CSV_CHUNK_ROWS, **options):
+    """分块读取CSV，逐块压缩数据类型后再拼接，避免完整的默认类型副本驻留内存"""
+    chunks, plan, before = [], None, 0
+    for chunk in pd.read_csv(io.BytesIO(data), chunksize=chunksize, **options):
+        before += frame_nbytes(chunk)
+        if plan is None:
+            plan = _plan_columns(chunk)
+        chunks.append(_apply_plan(chunk, plan))
+    if not chunks:
+        return compact_frame(pd.read_csv(io.BytesIO(data), **options))
+
+    # 各分块的类别集合不同，先统一类别，拼接后才能保持category类型
+    for col, kind in plan.items():
+        if kind == "category" and all(isinstance(c[col].dtype, pd.CategoricalDtype) for c in chunks):
+            categories = union_categoricals([c[col] for c in chunks]).categories
+            for c in chunks:
+                c[col] = c[col].cat.set_categories(categories)
+
+    df = pd.concat(chunks, ignore_index=True)
+    del chunks
+    df.attrs["memory_report"] = {"before": before, "after": frame_nbytes(df)}
+    return df
+
+
+def parse_upload(data, file_type, sheet_name=None, compact=False, **options):
+    with span("parse", file_type=file_type, compact=compact, input_bytes=len(data)) as attrs:
+        df = _parse_upload(data, file_type, sheet_name, compact, options)
+        attrs["rows"], attrs["df_bytes"] = len(df), df.attrs["memory_report"]["after"]
+    return df
+
+
+def _parse_upload(data, file_type, sheet_name, compact, options):
+    if file_type == "Excel":
+        with span("openpyxl"):
+            df = read_excel_sheet(data, sheet_name)
+        if compact:
+            with span("compact"):
+                return compact_frame(df)
+    elif compact:
+        return read_csv_compact(data, **options)
+    else:
+        df = pd.read_csv(io.BytesIO(data), **options)
+    nbytes = frame_nbytes(df)
+    df.attrs["memory_report"] = {"before": nbytes, "after": nbytes}
+    return df
+
+
+class DatasetStore:
+    """把解析后的数据集以Arrow IPC格式落盘一次，之后通过内存映射按列读取"""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return pa is not None
+
+    def _path(self, key):
+        return os.path.join(self.root, hashlib.sha256(repr(key).encode()).hexdigest()[:32] + ".arrow")
+
+    def _registry_path(self):
+        return os.path.join(self.root, "registry.json")
+
+    def _read_registry(self):
+        try:
+            with open(self._registry_path(), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+    def __contains__(self, key):
+        return self.enabled and os.path.exists(self._path(key))
+
+    def save(self, key, df, name=None):
+        if not self.enabled:
+            return False
+        with span("store.save"):
+            return self._save(key, df, name)
+
+    def _save(self, key, df, name):
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            # 混合类型的object列无法转成Arrow，跳过落盘但不影响本次加载
+            print(f"Dataset not persisted: {str(e)}")
+            return False
+
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+
+        content_hash, sheet_name, options = key
+        entry = {
+            "id": os.path.basename(path)[:-len(".arrow")],
+            "name": name or content_hash[:12],
+            "sheet": sheet_name,
+            "key": [content_hash, sheet_name, [list(item) for item in options]],
+            "rows": int(df.shape[0]),
+            "columns": int(df.shape[1]),
+            "memory_report": df.attrs.get("memory_report"),
+            "created": time.time(),
+        }
+        with self._lock:
+            registry = [e for e in self._read_registry() if e["id"] != entry["id"]]
+            registry.append(entry)
+            tmp_registry = f"{self._registry_path()}.tmp"
+            with open(tmp_registry, "w", encoding="utf-8") as f:
+                json.dump(registry, f, ensure_ascii=False)
+            os.replace(tmp_registry, self._registry_path())
+        return True
+
+    def load(self, key, columns=None):
+        """内存映射读取；指定 columns 时只触及这些列的数据页"""
+        if key not in self:
+            return None
+        with span("store.load", columns=len(columns) if columns is not None else None):
+            table = pa.ipc.open_file(pa.memory_map(self._path(key))).read_all()
+            if columns is not None:
+                table = table.select(list(columns))
+            df = table.to_pandas(split_blocks=True)
+        if columns is None:
+            entry = self.entry(key)
+            if entry and entry.get("memory_report"):
+                df.attrs["memory_report"] = entry["memory_report"]
+        return df
+
+    def entry(self, key):
+        dataset_id = os.path.basename(self._path(key))[:-len(".arrow")]
+        return next((e for e in self._read_registry() if e["id"] == dataset_id), None)
+
+    def list_datasets(self):
+        # 只返回数据文件仍然存在的记录，最近加载的排在前面
+        entries = [e for e in self._read_registry()
+                   if os.path.exists(os.path.join(self.root, e["id"] + ".arrow"))]
+        return sorted(entries, key=lambda e: e["created"], reverse=True)
+
+
+DATASET_STORE = DatasetStore(DATASET_STORE_DIR)
+
+
+def registry_key(entry):
+    content_hash, sheet_name, options = entry["key"]
+    return content_hash, sheet_name, tuple(tuple(item) for item in options)
+
+
+def _load_or_parse(key, data, file_type, sheet_name, name, options):
+    # 新会话/重启后先从列式存储内存映射读取，只有第一次才真正解析文件
+    df = DATASET_STORE.load(key)
+    if df is None:
+        df = parse_upload(data, file_type, sheet_name, **options)
+        DATASET_STORE.save(key, df, name=name if sheet_name is None else f"{name} / {sheet_name}")
+    return df
+
+
+def load_dataset(data, file_type, sheet_name=None, content_hash=None, name=None, **options):
+    """返回 (缓存键, DataFrame)；相同内容、工作表和解析参数直接命中缓存
+
+    返回的是共享数据的浅拷贝：与缓存中的数据共用内存，写入时才复制，不会改动其他会话看到的数据。
+    """
+    content_hash = content_hash or file_hash(data)
+    key = dataset_key(content_hash, sheet_name, **options)
+    df = DATASET_CACHE.get_or_load(
+        key,
+        lambda: _load_or_parse(key, data, file_type, sheet_name, name, options)
+    )
+    return key, df.copy(deep=False)
+
+
+def open_stored_dataset(entry):
+    """按注册表记录打开之前加载过的数据集"""
+    key = registry_key(entry)
+    if key not in DATASET_STORE:
+        raise FileNotFoundError(f"数据集 {entry['name']} 已不存在")
+    df = DATASET_CACHE.get_or_load(key, lambda: DATASET_STORE.load(key))
+    return key, df.copy(deep=False)
+
+
+def bind_dataset(session_id, key):
+    """登记会话当前使用的数据集；原来的数据集不再被任何会话引用时，按内存预算淘汰"""
+    DATASET_REGISTRY.bind(session_id, key)
+    DATASET_CACHE.trim()
+
+
+def release_dataset(session_id):
+    """会话不再使用任何数据集（如加载失败）时释放引用，不必等到空闲过期"""
+    DATASET_REGISTRY.release(session_id)
+    DATASET_CACHE.trim()
+
+
+def derived_column(dataset_key, df, col, name, transform):
+    """派生列（类型转换等）按 (数据集, 列, 名称) 单独缓存，不写回共享的数据集；没有数据集键时直接计算"""
+    if dataset_key is None:
+        return transform(df[col])
+    return DERIVED_CACHE.get_or_load((dataset_key, col, name), lambda: transform(df[col]))
+
+
+def load_columns(key, columns):
+    """列投影：已在内存中则直接取列，否则只从列式存储映射需要的列"""
+    columns = list(dict.fromkeys(columns))
+    df = DATASET_CACHE.get(key)
+    if df is not None:
+        return df[columns]
+    return DATASET_STORE.load(key, columns)
+
+
+_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=SHEET_PREFETCH_WORKERS,
+                                        thread_name_prefix="sheet-prefetch")
+# 已经预取过的上传（内容哈希 + 解析参数），每个上传只预取一次；被缓存淘汰的工作表在真正切换时再加载
+_prefetched = OrderedDict()
+_prefetch_lock = threading.Lock()
+
+
+def prefetch_sheets(data, file_type, sheet_names, content_hash=None, name=None, **options):
+    """在后台线程中解析其余工作表并放入缓存，切换工作表时直接命中"""
+    content_hash = content_hash or file_hash(data)
+    upload = dataset_key(content_hash, **options)
+    with _prefetch_lock:
+        if upload in _prefetched:
+            _prefetched.move_to_end(upload)
+            return
+        _prefetched[upload] = True
+        while len(_prefetched) > SHEET_PREFETCH_HISTORY:
+            _prefetched.popitem(last=False)
+    for sheet_name in sheet_names[:SHEET_PREFETCH_MAX]:
+        key = dataset_key(content_hash, sheet_name, **options)
+        if key in DATASET_CACHE:
+            continue
+        _PREFETCH_EXECUTOR.submit(
+            DATASET_CACHE.get_or_load, key,
+            lambda key=key, sheet_name=sheet_name: _load_or_parse(key, data, file_type, sheet_name, name, options)
+        )
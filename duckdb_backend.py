@@ -0,0 +1,269 @@
+import hashlib
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+from langchain_core.tools import BaseTool
+
+from dataset import dataset_key
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# DuckDB引擎：上传的文件统一转成Parquet存放在该目录，查询直接扫描文件，超出内存预算的中间结果落盘
+DUCKDB_DIR = os.getenv("DUCKDB_DIR", ".duckdb_store")
+DUCKDB_MEMORY_LIMIT = os.getenv("DUCKDB_MEMORY_LIMIT", "1GB")
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", str(os.cpu_count() or 2)))
+# 页面上允许直接读取的服务器数据目录；未设置时不提供按路径加载
+DUCKDB_DATA_DIR = os.getenv("DUCKDB_DATA_DIR", "")
+# SQL工具返回给智能体的最大行数和单条查询的超时（秒）
+SQL_MAX_ROWS = 50
+SQL_TIMEOUT = int(os.getenv("SQL_TIMEOUT", "60"))
+# 界面上用于生成列选项和预览的样本行数
+PREVIEW_ROWS = 1000
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def duckdb_available():
+    return duckdb is not None
+
+
+def _cursor():
+    # 每个进程一个数据库连接；cursor() 复制出独立的连接，可以在多个线程中并发查询
+    global _connection
+    with _connection_lock:
+        if _connection is None:
+            os.makedirs(DUCKDB_DIR, exist_ok=True)
+            _connection = duckdb.connect(config={
+                "memory_limit": DUCKDB_MEMORY_LIMIT,
+                "threads": DUCKDB_THREADS,
+                "temp_directory": os.path.join(DUCKDB_DIR, "tmp"),
+            })
+        return _connection.cursor()
+
+
+def quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _literal(text):
+    return "'" + str(text).replace("'", "''") + "'"
+
+
+class DuckTable:
+    """以Parquet文件为数据源的DuckDB表
+
+    只保存文件路径，所有计算都在DuckDB中向量化、按需落盘地执行；对象可以直接传给后台进程。
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self._rows = None
+        self._dtypes = None
+
+    @property
+    def source(self):
+        return f"read_parquet({_literal(self.path)})"
+
+    def query(self, sql, params=None):
+        cursor = _cursor()
+        try:
+            return cursor.execute(sql, params).df()
+        finally:
+            cursor.close()
+
+    def __len__(self):
+        if self._rows is None:
+            # Parquet元数据中记录了行数，不需要扫描数据
+            self._rows = int(self.query(f"SELECT count(*) AS n FROM {self.source}")["n"][0])
+        return self._rows
+
+    @property
+    def dtypes(self):
+        if self._dtypes is None:
+            self._dtypes = self.head(0).dtypes
+        return self._dtypes
+
+    @property
+    def columns(self):
+        return self.dtypes.index
+
+    @property
+    def shape(self):
+        return len(self), len(self.columns)
+
+    @property
+    def nbytes(self):
+        return os.path.getsize(self.path)
+
+    def head(self, n=5):
+        return self.query(f"SELECT * FROM {self.source} LIMIT {int(n)}")
+
+    def project(self, columns, limit=None, dropna=False):
+        columns = list(dict.fromkeys(columns))
+        sql = f"SELECT {', '.join(quote(c) for c in columns)} FROM {self.source}"
+        if dropna:
+            sql += " WHERE " + " AND ".join(f"{quote(c)} IS NOT NULL" for c in columns)
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return self.query(sql)
+
+    def group_stats(self, keys, y_cols, agg="mean", with_spread=False):
+        """分组聚合下推到DuckDB，返回与pandas分组聚合相同的长表：keys, variable, value, [std, n]
+
+        与 pandas groupby 一致：键为空的行不参与分组，全空组的求和为0。
+        """
+        exprs = {"mean": "avg({})::DOUBLE", "sum": "coalesce(sum({}), 0)::DOUBLE", "count": "count({})"}
+        selects = [quote(k) for k in keys]
+        for i, col in enumerate(y_cols):
+            selects.append(f"{exprs[agg].format(quote(col))} AS v{i}")
+            if with_spread:
+                selects.append(f"stddev_samp({quote(col)}) AS s{i}")
+                selects.append(f"count({quote(col)}) AS n{i}")
+        key_list = ", ".join(quote(k) for k in keys)
+        wide = self.query(f"SELECT {', '.join(selects)} FROM {self.source} "
+                          f"WHERE {' AND '.join(f'{quote(k)} IS NOT NULL' for k in keys)} "
+                          f"GROUP BY {key_list} ORDER BY {key_list}")
+
+        parts = []
+        for i, col in enumerate(y_cols):
+            part = wide[list(keys)].assign(variable=col, value=wide[f"v{i}"])
+            if with_spread:
+                part = part.assign(std=wide[f"s{i}"].astype("float64"), n=wide[f"n{i}"])
+            parts.append(part)
+        return pd.concat(parts, ignore_index=True)
+
+    def histogram2d(self, x_col, y_col, bins=200):
+        """二维网格分箱在DuckDB中完成，返回与 np.histogram2d 相同的 (counts, x_edges, y_edges)"""
+        x, y = quote(x_col), quote(y_col)
+        where = f"{x} IS NOT NULL AND {y} IS NOT NULL"
+        bounds = self.query(f"SELECT min({x})::DOUBLE AS x0, max({x})::DOUBLE AS x1, "
+                            f"min({y})::DOUBLE AS y0, max({y})::DOUBLE AS y1 FROM {self.source} WHERE {where}")
+        x0, x1, y0, y1 = bounds.iloc[0].tolist()
+        # 取值全部相同时和numpy一样把范围扩展为 ±0.5
+        if x0 == x1:
+            x0, x1 = x0 - 0.5, x1 + 0.5
+        if y0 == y1:
+            y0, y1 = y0 - 0.5, y1 + 0.5
+        cells = self.query(
+            f"SELECT least(floor(({x} - $x0) / ($x1 - $x0) * $bins), $bins - 1)::INTEGER AS i, "
+            f"least(floor(({y} - $y0) / ($y1 - $y0) * $bins), $bins - 1)::INTEGER AS j, count(*) AS c "
+            f"FROM {self.source} WHERE {where} GROUP BY i, j",
+            {"x0": x0, "x1": x1, "y0": y0, "y1": y1, "bins": bins},
+        )
+        counts = np.zeros((bins, bins))
+        counts[cells["i"].to_numpy(), cells["j"].to_numpy()] = cells["c"].to_numpy()
+        return counts, np.linspace(x0, x1, bins + 1), np.linspace(y0, y1, bins + 1)
+
+
+def server_data_path(path):
+    """把页面输入的路径解析为 DUCKDB_DATA_DIR 下的真实路径；目录外的路径（含符号链接、..）直接拒绝"""
+    if not DUCKDB_DATA_DIR:
+        raise PermissionError("未配置 DUCKDB_DATA_DIR，不能从服务器路径加载")
+    root = os.path.realpath(DUCKDB_DATA_DIR)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root or not os.path.isfile(resolved):
+        raise PermissionError(f"只能加载 {DUCKDB_DATA_DIR} 目录下的文件: {path}")
+    return resolved
+
+
+def register_file(file_type, data=None, path=None, content_hash=None):
+    """把CSV/Parquet注册为DuckTable，返回 (数据集键, DuckTable)
+
+    CSV只在第一次注册时由DuckDB流式转换成Parquet（不经过pandas），之后直接复用转换结果。
+    data 为上传文件的字节内容；path 为服务器上的文件路径，大文件不必经过浏览器上传。
+    """
+    if path is not None:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        # 服务器上的大文件按路径、大小和修改时间标识，不做整文件哈希
+        content_hash = content_hash or hashlib.sha256(f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()
+    else:
+        content_hash = content_hash or hashlib.sha256(data).hexdigest()
+    key = dataset_key(content_hash, engine="duckdb")
+
+    os.makedirs(DUCKDB_DIR, exist_ok=True)
+    target = os.path.join(DUCKDB_DIR, content_hash[:32] + ".parquet")
+    if file_type == "Parquet" and path is not None:
+        return key, DuckTable(path, key)
+    if not os.path.exists(target):
+        tmp_target = f"{target}.{threading.get_ident()}.tmp"
+        source = path
+        if path is None:
+            source = f"{target}.{threading.get_ident()}.upload"
+            with open(source, "wb") as f:
+                f.write(data)
+        try:
+            if file_type == "Parquet":
+                os.replace(source, target)
+            else:
+                cursor = _cursor()
+                try:
+                    cursor.execute(f"COPY (SELECT * FROM read_csv_auto({_literal(source)})) "
+                                   f"TO {_literal(tmp_target)} (FORMAT parquet)")
+                finally:
+                    cursor.close()
+                os.replace(tmp_target, target)
+        finally:
+            if path is None and os.path.exists(source):
+                os.remove(source)
+    return key, DuckTable(target, key)
+
+
+def _clean_sql(query):
+    # 去掉模型有时附带的代码块标记
+    query = query.strip().strip("`").strip()
+    return re.sub(r"^sql\s", "", query, flags=re.IGNORECASE).strip()
+
+
+def run_sql(table, sql, max_rows=SQL_MAX_ROWS, timeout=SQL_TIMEOUT):
+    """在名为 data 的临时视图上执行SQL，结果截断为 max_rows 行；超时会中断查询"""
+    cursor = _cursor()
+    interrupted = threading.Event()
+
+    def interrupt():
+        interrupted.set()
+        cursor.interrupt()
+
+    timer = threading.Timer(timeout, interrupt)
+    try:
+        cursor.execute(f"CREATE OR REPLACE TEMP VIEW data AS SELECT * FROM {table.source}")
+        timer.start()
+        relation = cursor.sql(_clean_sql(sql))
+        if relation is None:
+            return "OK"
+        result = relation.limit(max_rows + 1).df()
+    except Exception as e:
+        if interrupted.is_set():
+            return f"TimeoutError: 查询超过{timeout}秒被中断"
+        return f"{type(e).__name__}: {str(e)}"
+    finally:
+        timer.cancel()
+        cursor.close()
+    text = result.head(max_rows).to_string(index=False)
+    if len(result) > max_rows:
+        text += f"\n...（仅显示前{max_rows}行，请在SQL中聚合或加LIMIT）"
+    return text
+
+
+class DuckDBQueryTool(BaseTool):
+    """SQL工具：替代pandas智能体的Python工具，查询在DuckDB中执行"""
+
+    name: str = "sql_db_query"
+    description: str = (
+        "Execute a DuckDB SQL query against the table `data` and return the result. "
+        "Input should be a single valid DuckDB SQL query. "
+        f"At most {SQL_MAX_ROWS} rows are returned, so aggregate or use LIMIT in SQL."
+    )
+    path: str
+    key: tuple
+
+    def _run(self, query, run_manager=None):
+        return run_sql(DuckTable(self.path, self.key), query)
@@ -0,0 +1,134 @@
+import contextvars
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# 线程池处理LLM请求等I/O任务，进程池处理图表渲染等CPU密集任务
+JOB_IO_WORKERS = int(os.getenv("JOB_IO_WORKERS", "8"))
+JOB_CPU_WORKERS = int(os.getenv("JOB_CPU_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# 每个会话同时运行的任务数上限，超出的任务排队；每个会话保留的历史任务数
+JOB_SESSION_LIMIT = int(os.getenv("JOB_SESSION_LIMIT", "2"))
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", "30"))
+
+QUEUED, RUNNING, DONE, FAILED = "排队中", "运行中", "已完成", "失败"
+
+
+class Job:
+    def __init__(self, job_id, session_id, kind, label, fn, args, kwargs, cpu):
+        self.id = job_id
+        self.session_id = session_id
+        self.kind = kind
+        self.label = label
+        self.cpu = cpu
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._call = (fn, args, kwargs)
+        # 提交时的上下文（包括追踪所属的会话），线程池任务在其中运行
+        self._context = contextvars.copy_context()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+class JobScheduler:
+    """后台任务调度：按会话限制并发数，任务完成后自动启动同一会话排队中的任务
+
+    调度器是模块级单例，所有会话共享同一组线程池/进程池。
+    """
+
+    def __init__(self, io_workers, cpu_workers, session_limit, history_size):
+        self.session_limit = session_limit
+        self.history_size = history_size
+        self._io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="job-io")
+        self._cpu_workers = cpu_workers
+        self._cpu_pool = None
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._queued = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def _get_cpu_pool(self):
+        # 进程池按需创建；使用spawn避免在多线程的服务进程中fork。多个会话可能同时提交第一个任务，在锁内创建
+        with self._lock:
+            if self._cpu_pool is None:
+                self._cpu_pool = ProcessPoolExecutor(max_workers=self._cpu_workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            return self._cpu_pool
+
+    def _discard_cpu_pool(self, pool):
+        # 子进程异常退出（如渲染大图时内存不足）后进程池不可再用，丢弃后下一个任务重新创建
+        with self._lock:
+            if self._cpu_pool is pool:
+                self._cpu_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, session_id, kind, label, fn, *args, cpu=False, **kwargs):
+        with self._lock:
+            job = Job(next(self._ids), session_id, kind, label, fn, args, kwargs, cpu)
+            history = self._jobs.setdefault(session_id, deque())
+            history.appendleft(job)
+            # 只淘汰已结束的旧任务
+            while len(history) > self.history_size and history[-1].status in (DONE, FAILED):
+                history.pop()
+            self._queued.setdefault(session_id, deque()).append(job)
+        self._dispatch(session_id)
+        return job
+
+    def jobs(self, session_id):
+        with self._lock:
+            return list(self._jobs.get(session_id, ()))
+
+    def _dispatch(self, session_id):
+        with self._lock:
+            to_start = []
+            queue = self._queued.get(session_id, deque())
+            while queue and self._running.get(session_id, 0) < self.session_limit:
+                job = queue.popleft()
+                job.status, job.started = RUNNING, time.time()
+                self._running[session_id] = self._running.get(session_id, 0) + 1
+                to_start.append(job)
+        for job in to_start:
+            fn, args, kwargs = job._call
+            pool = self._get_cpu_pool() if job.cpu else self._io_pool
+            try:
+                if job.cpu:
+                    future = pool.submit(fn, *args, **kwargs)
+                else:
+                    future = pool.submit(job._context.run, fn, *args, **kwargs)
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._discard_cpu_pool(pool)
+                self._finish(job, None, e)
+                continue
+            future.add_done_callback(lambda f, job=job, pool=pool: self._done(job, pool, f))
+
+    def _done(self, job, pool, future):
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            self._discard_cpu_pool(pool)
+        self._finish(job, None if error is not None else future.result(), error)
+
+    def _finish(self, job, result, error):
+        with self._lock:
+            job.result, job.error = result, error
+            job.status = FAILED if error is not None else DONE
+            job.finished = time.time()
+            job._call = job._context = None
+            self._running[job.session_id] -= 1
+        self._dispatch(job.session_id)
+
+
+SCHEDULER = JobScheduler(JOB_IO_WORKERS, JOB_CPU_WORKERS, JOB_SESSION_LIMIT, JOB_HISTORY_SIZE)
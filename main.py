@@ -1,468 +1,740 @@
-# 必须放在最开始的Streamlit命令
-import streamlit as st
-import matplotlib.pyplot as plt
-import matplotlib.font_manager as fm
-from matplotlib import pyplot as plt
-import seaborn as sns
-import os
-import pandas as pd
-import openpyxl
-from langchain.memory import ConversationBufferMemory
-from langchain.chains import ConversationChain
-from langchain_openai import ChatOpenAI
-from utils import dataframe_agent
-
-
-import warnings
-from langchain_core._api.deprecation import LangChainDeprecationWarning
-
-# 忽略弃用警告
-warnings.filterwarnings("ignore", category=LangChainDeprecationWarning)
-
-# 然后继续使用旧代码
-from langchain.memory import ConversationBufferMemory
-st.session_state['memory'] = ConversationBufferMemory()
-
-
-plt.rcParams['font.sans-serif'] = ['SimHei']  # 指定默认字体为SimHei
-plt.rcParams['axes.unicode_minus'] = False  # 解决保存图像时负号'-'显示为方块的问题
-
-st.set_page_config(
-    page_title="互联数据分析智能体",
-    page_icon="📊",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
-# 自定义CSS样式
-st.markdown("""
-<style>
-    .main .block-container {
-        max-width: 95%;
-        padding-top: 1rem;
-    }
-    .data-section {
-        background: white;
-        border-radius: 10px;
-        padding: 1.5rem;
-        margin-bottom: 1.5rem;
-        box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-    }
-    .analysis-card {
-        background: #f8f9fa;
-        border-radius: 8px;
-        padding: 1rem;
-        margin-bottom: 1rem;
-        border-left: 4px solid #4a6baf;
-    }
-    .visualization-card {
-        background: #f8f9fa;
-        border-radius: 8px;
-        padding: 1rem;
-        border-left: 4px solid #28a745;
-    }
-    .stTabs [data-baseweb="tab-list"] {
-        gap: 10px;
-    }
-    .stTabs [data-baseweb="tab"] {
-        padding: 8px 16px;
-        border-radius: 4px 4px 0 0;
-    }
-    .stTabs [aria-selected="true"] {
-        background-color: #4a6baf;
-        color: white;
-    }
-    .chart-container {
-        margin-top: 20px;
-        padding: 15px;
-        border: 1px solid #eaeaea;
-        border-radius: 8px;
-        background: white;
-    }
-    .data-insight {
-        padding: 15px;
-        background-color: #f0f8ff;
-        border-radius: 8px;
-        margin-top: 15px;
-    }
-    .axis-label {
-        font-size: 14px;
-        font-weight: bold;
-        color: #333;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-# 初始化会话状态
-if 'messages' not in st.session_state:
-    st.session_state['messages'] = [{'role': 'ai', 'content': '你好主人，我是你的AI助手，我叫小美'}]
-    st.session_state['memory'] = ConversationBufferMemory()
-    st.session_state['API_KEY'] = ''
-    st.session_state['df'] = None
-    st.session_state['data_loaded'] = False
-
-# 侧边栏内容
-with st.sidebar:
-    st.subheader("🔑 OpenAI API 设置")
-    new_api_key = st.text_input('请输入OpenAI API Key:',
-                                type='password',
-                                value=st.session_state['API_KEY'],
-                                help="请输入有效的OpenAI API密钥以启用AI功能")
-
-    if st.button('验证API密钥', key='verify_api_key'):
-        if new_api_key.strip() == '':
-            st.error('API密钥不能为空！')
-        else:
-            st.session_state['API_KEY'] = new_api_key
-            st.success('API密钥验证成功！')
-
-    st.markdown("---")
-    function_selector = st.radio(
-        "选择功能模式:",
-        ("数据分析", "AI聊天"),
-        index=0,
-        horizontal=True
-    )
-
-# 主内容区域
-st.title("📈 智能数据分析平台")
-st.markdown("---")
-
-# ==================== 数据分析功能 ====================
-if function_selector == "数据分析":
-    # 数据上传部分
-
-    upload_col, preview_col = st.columns([1, 1])
-
-    with upload_col:
-        with st.expander("📂 上传数据", expanded=True):
-            file_type = st.radio("选择文件类型:", ["Excel", "CSV"], index=0, horizontal=True)
-            uploaded_file = st.file_uploader(f"上传{file_type}文件",
-                                             type="xlsx" if file_type == "Excel" else "csv",
-                                             help="支持.xlsx和.csv格式，最大100MB")
-
-            if uploaded_file:
-                try:
-                    if file_type == "Excel":
-                        wb = openpyxl.load_workbook(uploaded_file)
-                        sheet_names = wb.sheetnames
-                        selected_sheet = st.selectbox("选择工作表:", sheet_names)
-                        st.session_state['df'] = pd.read_excel(uploaded_file, sheet_name=selected_sheet)
-                    else:
-                        st.session_state['df'] = pd.read_csv(uploaded_file)
-
-                    st.session_state['data_loaded'] = True
-                    st.success("数据加载成功!")
-
-                except Exception as e:
-                    st.error(f"数据加载失败: {str(e)}")
-                    st.session_state['data_loaded'] = False
-
-    # 数据预览部分
-    if st.session_state.get('data_loaded', False):
-        with preview_col:
-            with st.expander("👀 数据预览", expanded=True):
-                st.dataframe(st.session_state['df'].head(8), use_container_width=True)
-
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.metric("总行数", st.session_state['df'].shape[0])
-                with col2:
-                    st.metric("总列数", st.session_state['df'].shape[1])
-
-                st.markdown("**数据类型分布**")
-                dtype_counts = st.session_state['df'].dtypes.value_counts()
-                dtype_df = pd.DataFrame({
-                    '数据类型': dtype_counts.index.astype(str),
-                    '数量': dtype_counts.values
-                })
-                st.dataframe(dtype_df, hide_index=True)
-
-    # 数据分析部分
-    if st.session_state.get('data_loaded', False):
-        # 分析和可视化标签页
-        tab1, tab2 = st.tabs(["🔍 数据分析", "📊 数据可视化"])
-
-        with tab1:
-            st.markdown("### 智能数据分析")
-            query = st.text_area("输入您的分析问题:",
-                                 height=100,
-                                 placeholder="例如: 显示销售额最高的5个产品\n或: 计算各地区的平均销售额")
-
-            if st.button("执行分析", key="run_analysis"):
-                if not query:
-                    st.warning("请输入分析问题")
-                else:
-                    with st.spinner("AI正在分析数据..."):
-                        try:
-                            result = dataframe_agent(st.session_state["df"], query)
-
-                            with st.container():
-                                st.markdown("#### 分析结果")
-                                if "answer" in result:
-                                    st.markdown(result["answer"])
-                                else:
-                                    st.info("未生成分析结果")
-
-                            if "table" in result:
-                                with st.container():
-                                    st.markdown("#### 数据表格")
-                                    st.dataframe(pd.DataFrame(
-                                        result["table"]["data"],
-                                        columns=result["table"]["columns"]
-                                    ), use_container_width=True)
-
-                        except Exception as e:
-                            error_msg = str(e)
-                            if '402' in error_msg or 'Insufficient Balance' in error_msg:
-                                st.error("分析失败: OpenAI API 余额不足，请充值或检查API密钥")
-                            else:
-                                st.error(f"分析失败: {error_msg}")
-
-        with tab2:
-            st.markdown("### 交互式数据可视化")
-            if st.session_state['df'] is not None:
-                # 获取数值列和非数值列
-                numeric_cols = st.session_state['df'].select_dtypes(include=['number']).columns.tolist()
-                other_cols = [col for col in st.session_state['df'].columns if col not in numeric_cols]
-
-                # 确保有足够的列进行可视化
-                if len(numeric_cols) == 0:
-                    st.warning("数据中没有数值列，无法进行可视化分析")
-                elif len(other_cols) == 0:
-                    st.warning("数据中没有分类列，无法进行分组可视化")
-                else:
-                    # 图表类型选择
-                    chart_options = ["柱状图", "折线图", "散点图", "饼图"]
-                    chart_type = st.selectbox("选择图表类型", chart_options, index=0)
-
-                    # 列选择器
-                    col1, col2 = st.columns(2)
-
-                    with col1:
-                        # X轴选择（分类数据）
-                        x_options = other_cols if other_cols else st.session_state['df'].columns
-                        x_col = st.selectbox("选择X轴（分类数据）",
-                                             options=x_options,
-                                             index=0 if len(x_options) > 0 else None,
-                                             help="选择包含类别信息的列")
-
-                        # 添加X轴标签设置
-                        x_label = st.text_input("X轴标签:", value=x_col if x_col else "",
-                                                help="自定义X轴显示文字")
-
-                    with col2:
-                        # Y轴选择（数值数据）
-                        y_cols = st.multiselect("选择Y轴（数值数据）",
-                                                options=numeric_cols,
-                                                default=[numeric_cols[0]] if numeric_cols else None,
-                                                help="选择一个或多个数值列")
-
-                        # 添加Y轴标签设置
-                        y_label = st.text_input("Y轴标签:", value="数值" if y_cols else "",
-                                                help="自定义Y轴显示文字")
-
-                    # 分组变量（仅适用于柱状图和折线图）
-                    if chart_type in ["柱状图", "折线图"] and other_cols:
-                        hue_col = st.selectbox("分组变量（可选）",
-                                               options=["无"] + other_cols,
-                                               index=0,
-                                               help="根据类别分组显示数据")
-                        hue_col = None if hue_col == "无" else hue_col
-                    else:
-                        hue_col = None
-
-                    # 图表生成按钮
-                    if st.button("生成图表", key="generate_chart"):
-                        if not y_cols:
-                            st.warning("请至少选择一个Y轴数据列")
-                        else:
-                            with st.spinner("正在生成图表..."):
-                                try:
-                                    # 创建图表容器
-                                    with st.container():
-                                        st.markdown("#### 数据可视化结果")
-                                        fig, ax = plt.subplots(figsize=(10, 6))
-                                        plt.style.use('seaborn-v0_8')
-                                        plt.grid(True, linestyle='--', alpha=0.3)
-                                        plt.rcParams['font.sans-serif'] = ['SimHei']  # 指定默认字体为SimHei
-                                        plt.rcParams['axes.unicode_minus'] = False  # 解决保存图像时负号'-'显示为方块的问题
-
-                                        # 柱状图
-                                        if chart_type == "柱状图" and x_col and y_cols:
-                                            # 确保数据是分类类型
-                                            if pd.api.types.is_numeric_dtype(st.session_state['df'][x_col]):
-                                                st.session_state['df'][x_col] = st.session_state['df'][x_col].astype(
-                                                    str)
-
-                                            if len(y_cols) == 1:
-                                                # 单Y轴柱状图
-                                                sns.barplot(data=st.session_state['df'],
-                                                            x=x_col,
-                                                            y=y_cols[0],
-                                                            hue=hue_col,
-                                                            ax=ax,
-                                                            palette="Blues_d")
-                                                ax.set_ylabel(y_cols[0])
-                                            else:
-                                                # 多Y轴柱状图处理
-                                                plot_df = st.session_state['df'].groupby(x_col)[
-                                                    y_cols].mean().reset_index()
-                                                plot_df.plot(x=x_col, y=y_cols, kind='bar', ax=ax,
-                                                             color=['#4a6baf', '#3a5a9f', '#2a4a8f'])
-                                                ax.set_ylabel("平均值")
-
-                                        # 折线图
-                                        elif chart_type == "折线图" and x_col and y_cols:
-                                            # 确保数据是分类类型
-                                            if pd.api.types.is_numeric_dtype(st.session_state['df'][x_col]):
-                                                st.session_state['df'][x_col] = st.session_state['df'][x_col].astype(
-                                                    str)
-
-                                            for col in y_cols:
-                                                sns.lineplot(data=st.session_state['df'],
-                                                             x=x_col,
-                                                             y=col,
-                                                             hue=hue_col,
-                                                             ax=ax,
-                                                             marker='o',
-                                                             linewidth=2.5)
-                                            ax.set_ylabel("数值")
-
-                                        # 散点图
-                                        elif chart_type == "散点图" and x_col and y_cols and len(y_cols) >= 1:
-                                            # 确保使用数值列
-                                            if not pd.api.types.is_numeric_dtype(st.session_state['df'][x_col]):
-                                                st.warning("散点图X轴需要数值数据")
-                                            else:
-                                                sns.scatterplot(data=st.session_state['df'],
-                                                                x=x_col,
-                                                                y=y_cols[0],
-                                                                ax=ax,
-                                                                s=100,
-                                                                color="#4a6baf")
-                                                ax.set_ylabel(y_cols[0])
-
-                                        # 饼图
-                                        elif chart_type == "饼图" and x_col and y_cols and len(y_cols) == 1:
-                                            # 确保数据是分类类型
-                                            if pd.api.types.is_numeric_dtype(st.session_state['df'][x_col]):
-                                                st.session_state['df'][x_col] = st.session_state['df'][x_col].astype(
-                                                    str)
-
-                                            # 聚合数据
-                                            plot_df = st.session_state['df'].groupby(x_col)[y_cols[0]].sum()
-
-                                            # 过滤掉空值
-                                            plot_df = plot_df[plot_df > 0]
-
-                                            if len(plot_df) > 0:
-                                                plot_df.plot(kind='pie',
-                                                             autopct='%1.1f%%',
-                                                             ax=ax,
-                                                             colors=sns.color_palette("Blues", len(plot_df)),
-                                                             startangle=90,
-                                                             ylabel="")
-                                                ax.set_ylabel("")
-                                            else:
-                                                st.warning("没有有效数据生成饼图")
-
-                                        # 设置图表标题和标签
-                                        if x_col and y_cols:
-                                            title = f"{chart_type}: {x_col} vs {', '.join(y_cols)}"
-                                            if hue_col:
-                                                title += f" (按 {hue_col} 分组)"
-                                            ax.set_title(title, fontsize=14)
-
-                                            # 设置X轴和Y轴标签（饼图除外）
-                                            if chart_type != "饼图":
-                                                ax.set_xlabel(x_label, fontsize=12, fontweight='bold', labelpad=10)
-                                                ax.set_ylabel(y_label, fontsize=12, fontweight='bold', labelpad=10)
-
-                                                # 添加CSS类名
-                                                ax.xaxis.label.set_color('#333')
-                                                ax.yaxis.label.set_color('#333')
-
-                                        # 美化图表
-                                        plt.xticks(rotation=45, ha='right')
-                                        plt.tight_layout()
-
-                                        # 显示图表
-                                        st.pyplot(fig)
-
-                                        # 添加数据洞察
-                                        if x_col and y_cols:
-                                            with st.container():
-                                                st.markdown("##### 数据洞察", unsafe_allow_html=True)
-                                                insight_text = ""
-
-                                                if chart_type == "柱状图":
-                                                    insight_text = f"此柱状图展示了不同 **{x_col}** 类别的 **{', '.join(y_cols)}** 值分布"
-                                                elif chart_type == "折线图":
-                                                    insight_text = f"此折线图展示了 **{', '.join(y_cols)}** 随时间或类别的变化趋势"
-                                                elif chart_type == "散点图":
-                                                    insight_text = f"此散点图展示了 **{x_col}** 与 **{y_cols[0]}** 之间的关系"
-                                                elif chart_type == "饼图":
-                                                    insight_text = f"此饼图展示了不同 **{x_col}** 类别在 **{y_cols[0]}** 中的占比"
-
-                                                if insight_text:
-                                                    st.markdown(f'<div class="data-insight">{insight_text}</div>',
-                                                                unsafe_allow_html=True)
-
-                                except Exception as e:
-                                    st.error(f"图表生成失败: {str(e)}")
-
-# ==================== AI聊天功能 ====================
-elif function_selector == "AI聊天":
-    # AI聊天功能
-    st.subheader("💬 AI聊天助手")
-
-    if not st.session_state['API_KEY']:
-        st.warning('请先在侧边栏输入OpenAI API Key！')
-
-    # 显示聊天历史
-    for message in st.session_state['messages']:
-        with st.chat_message(message['role']):
-            st.markdown(message['content'])
-
-    # 处理用户输入
-    if prompt := st.chat_input("输入您的问题..."):
-        if not st.session_state['API_KEY']:
-            st.info('请先输入OpenAI API Key！')
-            st.stop()
-
-        # 添加用户消息
-        st.session_state['messages'].append({'role': 'human', 'content': prompt})
-
-        # 实时显示用户消息
-        with st.chat_message("human"):
-            st.markdown(prompt)
-
-        with st.spinner('AI正在思考...'):
-            try:
-                # 创建AI模型
-                model = ChatOpenAI(
-                    model='gpt-4',
-                    api_key=st.session_state['API_KEY'],
-                    base_url='https://twapi.openai-hk.com/v1'
-                )
-
-                # 创建对话链
-                chain = ConversationChain(llm=model, memory=st.session_state['memory'])
-
-                # 获取AI响应
-                response = chain.invoke({'input': prompt})['response']
-
-                # 添加AI响应
-                st.session_state['messages'].append({'role': 'ai', 'content': response})
-
-                # 实时显示AI响应
-                with st.chat_message("ai"):
-                    st.markdown(response)
-
-            except Exception as e:
-                error_msg = str(e)
-                if '402' in error_msg or 'Insufficient Balance' in error_msg:
-                    st.error("聊天失败: OpenAI API 余额不足，请充值或检查API密钥")
-                else:
-                    st.error(f"聊天出错: {error_msg}")
+# 必须放在最开始的Streamlit命令
+import streamlit as st
+import matplotlib.pyplot as plt
+import matplotlib.font_manager as fm
+from matplotlib import pyplot as plt
+import os
+import json
+import uuid
+from contextlib import nullcontext
+import pandas as pd
+from jobs import DONE, FAILED, SCHEDULER
+from planner import PLANNER_STATS
+from profiling import cached_profile
+from tracing import CACHES, TRACE_LOG, TRACE_LOG_PATH, bind_session, max_rss_bytes, span, trace
+from utils import (CHAT_MEMORY_TOKENS, OPENAI_BASE_URL, QUERY_CACHE, build_chat_memory, get_chat_model,
+                   dataframe_agent, stream_chat_reply, stream_dataframe_agent)
+from charts import (AGG_FUNCS, DOWNSAMPLE_THRESHOLD, SCATTER_BIN_MODES, cached_render_chart, chart_columns,
+                    render_chart_job)
+from duckdb_backend import DUCKDB_DATA_DIR, PREVIEW_ROWS, duckdb_available, register_file, server_data_path
+from dataset import (DATASET_CACHE, DATASET_REGISTRY, DATASET_STORE, bind_dataset, excel_sheet_names, file_hash,
+                     format_bytes, load_columns, load_dataset, open_stored_dataset, prefetch_sheets,
+                     release_dataset)
+
+
+import warnings
+from langchain_core._api.deprecation import LangChainDeprecationWarning
+
+# 忽略弃用警告
+warnings.filterwarnings("ignore", category=LangChainDeprecationWarning)
+
+
+plt.rcParams['font.sans-serif'] = ['SimHei']  # 指定默认字体为SimHei
+plt.rcParams['axes.unicode_minus'] = False  # 解决保存图像时负号'-'显示为方块的问题
+
+st.set_page_config(
+    page_title="互联数据分析智能体",
+    page_icon="📊",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+# 自定义CSS样式
+st.markdown("""
+<style>
+    .main .block-container {
+        max-width: 95%;
+        padding-top: 1rem;
+    }
+    .data-section {
+        background: white;
+        border-radius: 10px;
+        padding: 1.5rem;
+        margin-bottom: 1.5rem;
+        box-shadow: 0 2px 8px rgba(0,0,0,0.1);
+    }
+    .analysis-card {
+        background: #f8f9fa;
+        border-radius: 8px;
+        padding: 1rem;
+        margin-bottom: 1rem;
+        border-left: 4px solid #4a6baf;
+    }
+    .visualization-card {
+        background: #f8f9fa;
+        border-radius: 8px;
+        padding: 1rem;
+        border-left: 4px solid #28a745;
+    }
+    .stTabs [data-baseweb="tab-list"] {
+        gap: 10px;
+    }
+    .stTabs [data-baseweb="tab"] {
+        padding: 8px 16px;
+        border-radius: 4px 4px 0 0;
+    }
+    .stTabs [aria-selected="true"] {
+        background-color: #4a6baf;
+        color: white;
+    }
+    .chart-container {
+        margin-top: 20px;
+        padding: 15px;
+        border: 1px solid #eaeaea;
+        border-radius: 8px;
+        background: white;
+    }
+    .data-insight {
+        padding: 15px;
+        background-color: #f0f8ff;
+        border-radius: 8px;
+        margin-top: 15px;
+    }
+    .axis-label {
+        font-size: 14px;
+        font-weight: bold;
+        color: #333;
+    }
+</style>
+""", unsafe_allow_html=True)
+
+# 初始化会话状态
+if 'messages' not in st.session_state:
+    st.session_state['messages'] = [{'role': 'ai', 'content': '你好主人，我是你的AI助手，我叫小美'}]
+    # 对话记忆在首次聊天时按API密钥创建，之后在整个会话中保留
+    st.session_state['memory'] = None
+    st.session_state['chat_usage'] = []
+    st.session_state['API_KEY'] = ''
+    st.session_state['df'] = None
+    st.session_state['dataset_key'] = None
+    st.session_state['data_loaded'] = False
+st.session_state.setdefault('session_id', uuid.uuid4().hex)
+st.session_state.setdefault('table', None)
+st.session_state.setdefault('BASE_URL', OPENAI_BASE_URL)
+# 本次运行（以及从这里提交的后台任务）中的追踪都归属到当前会话
+bind_session(st.session_state['session_id'])
+# 每次交互都刷新会话对数据集的引用，长时间无操作的会话不再阻止数据集被淘汰
+DATASET_REGISTRY.touch(st.session_state['session_id'])
+
+
+def data_source():
+    # DuckDB引擎下分析和图表直接查询磁盘上的表，st.session_state['df'] 只是用于预览和列选项的样本
+    table = st.session_state.get('table')
+    return table if table is not None else st.session_state['df']
+
+
+def load_trace(source, **attrs):
+    # 只追踪数据源变化后的第一次加载，之后每次重跑命中缓存的加载不再记录
+    if st.session_state.get('loaded_source') == source:
+        return nullcontext({})
+    st.session_state['loaded_source'] = source
+    return trace("load", **attrs)
+
+
+TRACE_LABELS = {"load": "数据加载", "analysis": "数据分析", "chart": "图表生成", "chat": "AI聊天"}
+
+
+def show_diagnostics():
+    records = TRACE_LOG.recent(st.session_state['session_id'])
+    if not records:
+        st.caption("暂无记录，执行加载、分析、图表或聊天后显示各阶段耗时")
+    else:
+        last = records[0]
+        st.markdown(f"**最近一次{TRACE_LABELS.get(last['trace'], last['trace'])}**：{last['duration_ms']:,.0f} ms"
+                    f"（{last['status']}）")
+        if last['spans']:
+            st.dataframe(pd.DataFrame([{
+                '阶段': item['name'],
+                '开始(ms)': round(item['offset_ms']),
+                '耗时(ms)': round(item['duration_ms'], 1),
+            } for item in last['spans']]), hide_index=True, use_container_width=True)
+        details = {key: value for key, value in last['attrs'].items() if value is not None}
+        details.update({f"缓存 {name}": f"{c['hits']}/{c['hits'] + c['misses']}"
+                        for name, c in last['resources']['caches'].items()})
+        st.caption(" ｜ ".join(f"{key}: {value:,.0f}" if isinstance(value, float) else f"{key}: {value}"
+                               for key, value in details.items()))
+
+        st.markdown("**各阶段耗时汇总（本会话）**")
+        st.dataframe(pd.DataFrame([{
+            '阶段': item['stage'], '次数': item['count'], 'p50(ms)': round(item['p50_ms'], 1),
+            'p95(ms)': round(item['p95_ms'], 1), '总计(ms)': round(item['total_ms']),
+        } for item in TRACE_LOG.stage_summary(st.session_state['session_id'])]),
+            hide_index=True, use_container_width=True)
+
+        st.download_button("导出JSONL", data="\n".join(json.dumps(r, ensure_ascii=False, default=str)
+                                                        for r in reversed(records)),
+                           file_name="traces.jsonl", mime="application/jsonl", key="export_traces")
+
+    st.markdown("**缓存命中率（所有会话）**")
+    st.dataframe(pd.DataFrame([{
+        '缓存': name, '命中': cache.hits, '未命中': cache.misses,
+        '命中率': f"{cache.hits / (cache.hits + cache.misses):.0%}" if cache.hits + cache.misses else "-",
+    } for name, cache in CACHES.items()]), hide_index=True, use_container_width=True)
+    st.caption(f"数据集缓存 {format_bytes(DATASET_CACHE.nbytes)} / {format_bytes(DATASET_CACHE.max_bytes)}，"
+               f"{len(DATASET_CACHE)} 个数据集，其中 {sum(key in DATASET_CACHE for key in DATASET_REGISTRY.referenced_keys())} 个正被会话使用")
+    rss = max_rss_bytes()
+    st.caption((f"进程峰值内存 {format_bytes(rss)} ｜ " if rss else "") + f"日志文件 {TRACE_LOG_PATH}")
+
+
+def show_analysis_result(result):
+    with st.container():
+        st.markdown("#### 分析结果")
+        if "answer" in result:
+            st.markdown(str(result["answer"]))
+        elif not any(kind in result for kind in ("table", "bar", "line")):
+            st.info("未生成分析结果")
+
+    # 柱状图/折线图结果：columns 为类别，data 为对应的数值
+    for kind, draw in (("bar", st.bar_chart), ("line", st.line_chart)):
+        if kind in result:
+            with st.container():
+                st.markdown("#### 柱状图" if kind == "bar" else "#### 折线图")
+                series = result[kind]
+                n = min(len(series["columns"]), len(series["data"]))
+                draw(pd.DataFrame({"数值": series["data"][:n]}, index=pd.Index(series["columns"][:n], name="类别")))
+
+    if "table" in result:
+        with st.container():
+            st.markdown("#### 数据表格")
+            st.dataframe(pd.DataFrame(
+                result["table"]["data"],
+                columns=result["table"]["columns"]
+            ), use_container_width=True)
+
+
+@st.fragment(run_every=2)
+def job_panel():
+    # 每2秒局部刷新，只重跑任务列表，不影响页面其他部分
+    jobs = SCHEDULER.jobs(st.session_state['session_id'])
+    if not jobs:
+        st.caption("暂无后台任务")
+        return
+    for job in jobs:
+        kind = "分析" if job.kind == "analysis" else "图表"
+        title = f"#{job.id} [{kind}] {job.label} — {job.status}（{job.elapsed:.1f}秒）"
+        if job.status not in (DONE, FAILED):
+            st.markdown(f"⏳ {title}")
+            continue
+        with st.expander(("✅ " if job.status == DONE else "❌ ") + title, expanded=False):
+            if job.status == FAILED:
+                error_msg = str(job.error)
+                if '402' in error_msg or 'Insufficient Balance' in error_msg:
+                    st.error("任务失败: OpenAI API 余额不足，请充值或检查API密钥")
+                else:
+                    st.error(f"任务失败: {error_msg}")
+            elif job.kind == "analysis":
+                show_analysis_result(job.result)
+            else:
+                for warning in job.result['warnings']:
+                    st.warning(warning)
+                st.image(job.result['image'], use_container_width=True)
+
+
+# 侧边栏内容
+with st.sidebar:
+    st.subheader("🔑 OpenAI API 设置")
+    new_api_key = st.text_input('请输入OpenAI API Key:',
+                                type='password',
+                                value=st.session_state['API_KEY'],
+                                help="请输入有效的OpenAI API密钥以启用AI功能")
+
+    st.session_state['BASE_URL'] = st.text_input('API地址:',
+                                                 value=st.session_state['BASE_URL'],
+                                                 help="OpenAI兼容接口地址，可指向本地的 mock_server.py 做离线测试") \
+        or OPENAI_BASE_URL
+
+    if st.button('验证API密钥', key='verify_api_key'):
+        if new_api_key.strip() == '':
+            st.error('API密钥不能为空！')
+        else:
+            st.session_state['API_KEY'] = new_api_key
+            st.success('API密钥验证成功！')
+
+    st.markdown("---")
+    function_selector = st.radio(
+        "选择功能模式:",
+        ("数据分析", "AI聊天"),
+        index=0,
+        horizontal=True
+    )
+
+# 主内容区域
+st.title("📈 智能数据分析平台")
+st.markdown("---")
+
+# ==================== 数据分析功能 ====================
+if function_selector == "数据分析":
+    # 数据上传部分
+
+    upload_col, preview_col = st.columns([1, 1])
+
+    with upload_col:
+        with st.expander("📂 上传数据", expanded=True):
+            engine = "pandas"
+            if duckdb_available():
+                engine = st.radio("计算引擎:", ["pandas", "DuckDB"], index=0, horizontal=True,
+                                  help="DuckDB直接在磁盘上的Parquet文件中查询，适合超出内存的大文件（仅支持CSV/Parquet）")
+            if engine == "DuckDB":
+                file_type = st.radio("选择文件类型:", ["CSV", "Parquet"], index=0, horizontal=True)
+                uploaded_file = st.file_uploader(f"上传{file_type}文件", type=file_type.lower())
+                server_path = ""
+                if DUCKDB_DATA_DIR:
+                    server_path = st.text_input("或输入服务器数据目录中的文件路径:",
+                                                help=f"{DUCKDB_DATA_DIR} 目录下的大文件可以直接从磁盘读取，不经过浏览器上传")
+            else:
+                file_type = st.radio("选择文件类型:", ["Excel", "CSV"], index=0, horizontal=True)
+                uploaded_file = st.file_uploader(f"上传{file_type}文件",
+                                                 type="xlsx" if file_type == "Excel" else "csv",
+                                                 help="支持.xlsx和.csv格式，最大100MB")
+                compact = st.checkbox("紧凑加载", value=True,
+                                      help="分块读取并压缩数据类型（重复文本转为分类、日期文本转为日期类型），显著降低内存占用")
+                server_path = ""
+
+            # 之前加载过的数据集已落盘为列式文件，可直接内存映射打开
+            stored_entry = None
+            stored_datasets = DATASET_STORE.list_datasets() if engine == "pandas" else []
+            if stored_datasets and not uploaded_file:
+                stored_options = {f"{e['name']}（{e['rows']}行 × {e['columns']}列）": e for e in stored_datasets}
+                stored_choice = st.selectbox("或选择已加载的数据集:", ["无"] + list(stored_options))
+                stored_entry = stored_options.get(stored_choice)
+
+            if uploaded_file:
+                try:
+                    data = uploaded_file.getvalue()
+                    # 同一上传文件在重跑时只计算一次内容哈希
+                    file_id = getattr(uploaded_file, 'file_id', uploaded_file.name)
+                    if st.session_state.get('upload_hash', (None, None))[0] != file_id:
+                        st.session_state['upload_hash'] = (file_id, file_hash(data))
+                    content_hash = st.session_state['upload_hash'][1]
+
+                    if engine == "DuckDB":
+                        with load_trace((content_hash, engine), engine=engine, file_type=file_type,
+                                        input_bytes=len(data)):
+                            with st.spinner("正在注册到DuckDB..."):
+                                key, table = register_file(file_type, data=data, content_hash=content_hash)
+                            df = table.head(PREVIEW_ROWS)
+                    elif file_type == "Excel":
+                        sheet_names = excel_sheet_names(data, content_hash)
+                        selected_sheet = st.selectbox("选择工作表:", sheet_names)
+                        with load_trace((content_hash, selected_sheet, compact), engine=engine, file_type=file_type,
+                                        input_bytes=len(data)) as attrs:
+                            key, df = load_dataset(data, file_type, selected_sheet, content_hash=content_hash,
+                                                   name=uploaded_file.name, compact=compact)
+                            attrs['df_bytes'] = df.attrs.get('memory_report', {}).get('after')
+                        prefetch_sheets(data, file_type, sheet_names, content_hash=content_hash,
+                                        name=uploaded_file.name, compact=compact)
+                    else:
+                        with load_trace((content_hash, None, compact), engine=engine, file_type=file_type,
+                                        input_bytes=len(data)) as attrs:
+                            key, df = load_dataset(data, file_type, content_hash=content_hash,
+                                                   name=uploaded_file.name, compact=compact)
+                            attrs['df_bytes'] = df.attrs.get('memory_report', {}).get('after')
+
+                    st.session_state['dataset_key'] = key
+                    st.session_state['df'] = df
+                    st.session_state['table'] = table if engine == "DuckDB" else None
+                    bind_dataset(st.session_state['session_id'], key)
+
+                    st.session_state['data_loaded'] = True
+                    st.success("数据加载成功!")
+
+                except Exception as e:
+                    st.error(f"数据加载失败: {str(e)}")
+                    st.session_state['data_loaded'] = False
+                    release_dataset(st.session_state['session_id'])
+
+            elif server_path.strip():
+                try:
+                    with load_trace(server_path.strip(), engine=engine, file_type=file_type):
+                        with st.spinner("正在注册到DuckDB..."):
+                            key, table = register_file(file_type, path=server_data_path(server_path.strip()))
+                    st.session_state['dataset_key'] = key
+                    st.session_state['df'] = table.head(PREVIEW_ROWS)
+                    st.session_state['table'] = table
+                    bind_dataset(st.session_state['session_id'], key)
+                    st.session_state['data_loaded'] = True
+                    st.success("数据加载成功!")
+
+                except Exception as e:
+                    st.error(f"数据加载失败: {str(e)}")
+                    st.session_state['data_loaded'] = False
+                    release_dataset(st.session_state['session_id'])
+
+            elif stored_entry:
+                try:
+                    with load_trace(stored_entry['id'], engine=engine, file_type="stored") as attrs:
+                        key, df = open_stored_dataset(stored_entry)
+                        attrs['df_bytes'] = df.attrs.get('memory_report', {}).get('after')
+                    st.session_state['dataset_key'] = key
+                    st.session_state['df'] = df
+                    st.session_state['table'] = None
+                    bind_dataset(st.session_state['session_id'], key)
+                    st.session_state['data_loaded'] = True
+                    st.success("数据加载成功!")
+
+                except Exception as e:
+                    st.error(f"数据加载失败: {str(e)}")
+                    st.session_state['data_loaded'] = False
+                    release_dataset(st.session_state['session_id'])
+
+    # 数据预览部分
+    if st.session_state.get('data_loaded', False):
+        with preview_col:
+            with st.expander("👀 数据预览", expanded=True):
+                st.dataframe(st.session_state['df'].head(8), use_container_width=True)
+
+                # 数据集概况每个数据集只统计一次，与分析智能体的提示词共用
+                profile = cached_profile(st.session_state['dataset_key'], data_source())
+
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("总行数", profile['rows'])
+                with col2:
+                    st.metric("总列数", len(profile['columns']))
+                with col3:
+                    # 加载时已记录内存占用，避免每次重跑都做深度统计
+                    report = st.session_state['df'].attrs.get('memory_report')
+                    if st.session_state['table'] is not None:
+                        st.metric("磁盘占用", format_bytes(st.session_state['table'].nbytes))
+                    elif report:
+                        saved = report['after'] / report['before'] - 1 if report['before'] else 0
+                        st.metric("内存占用", format_bytes(report['after']),
+                                  delta=f"{saved:.1%}（原 {format_bytes(report['before'])}）" if saved else None,
+                                  delta_color="inverse")
+
+                st.markdown("**数据类型分布**")
+                dtype_df = pd.DataFrame({
+                    '数据类型': list(profile['dtype_counts']),
+                    '数量': list(profile['dtype_counts'].values())
+                })
+                st.dataframe(dtype_df, hide_index=True)
+
+                st.markdown("**列概况**")
+                column_df = pd.DataFrame([{
+                    '列名': c['name'],
+                    '类型': c['dtype'],
+                    '不同值': c['nunique'],
+                    '缺失率': f"{c['null_rate']:.1%}",
+                    '范围/常见值': (", ".join(f"{v}({n})" for v, n in c['top']) if 'top' in c
+                                   else f"{c['min']} ~ {c['max']}"),
+                } for c in profile['columns']])
+                st.dataframe(column_df, hide_index=True, use_container_width=True)
+
+                sharing = DATASET_REGISTRY.refcount(st.session_state['dataset_key'])
+                if sharing > 1:
+                    st.caption(f"该数据集当前由 {sharing} 个会话共享同一份内存")
+
+    # 数据分析部分
+    if st.session_state.get('data_loaded', False):
+        # 分析和可视化标签页
+        tab1, tab2 = st.tabs(["🔍 数据分析", "📊 数据可视化"])
+
+        with tab1:
+            st.markdown("### 智能数据分析")
+            query = st.text_area("输入您的分析问题:",
+                                 height=100,
+                                 placeholder="例如: 显示销售额最高的5个产品\n或: 计算各地区的平均销售额")
+
+            run_in_background = st.checkbox("后台执行", key="analysis_background",
+                                            help="提交到后台任务队列，可以同时提交多个问题和图表")
+
+            if st.button("执行分析", key="run_analysis"):
+                if not query:
+                    st.warning("请输入分析问题")
+                elif run_in_background:
+                    dataset_key = st.session_state.get('dataset_key')
+                    job = SCHEDULER.submit(st.session_state['session_id'], "analysis", query,
+                                           dataframe_agent, data_source(), query,
+                                           fingerprint=repr(dataset_key) if dataset_key else None,
+                                           dataset_key=dataset_key, base_url=st.session_state['BASE_URL'])
+                    st.success(f"已提交后台任务 #{job.id}，可在下方任务列表查看进度")
+                else:
+                    # 分析过程中点击停止（或任意交互）会中断本次运行，智能体在下一步之前停止
+                    st.button("⏹ 停止分析", key="stop_analysis")
+                    with st.status("AI正在分析数据...", expanded=True) as status:
+                        try:
+                            dataset_key = st.session_state.get('dataset_key')
+                            result = {}
+                            # 实时展示智能体的思考、工具调用和执行结果
+                            for event in stream_dataframe_agent(data_source(), query,
+                                                                fingerprint=repr(dataset_key) if dataset_key else None,
+                                                                dataset_key=dataset_key,
+                                                                base_url=st.session_state['BASE_URL']):
+                                if event['type'] == 'action':
+                                    if event['thought']:
+                                        st.markdown(f"**思考**：{event['thought']}")
+                                    st.code(str(event['input']),
+                                            language='sql' if event['tool'] == 'sql_db_query' else 'python')
+                                elif event['type'] == 'observation':
+                                    st.text(str(event['output'])[:2000])
+                                else:
+                                    result = event['result']
+                                    st.caption({'cache': "结果来自缓存", 'planner': "结果由快速通道直接计算",
+                                                'agent': "结果由AI智能体生成"}[event['source']])
+                            status.update(label="分析完成", state="complete", expanded=False)
+                            show_analysis_result(result)
+
+                        except Exception as e:
+                            status.update(label="分析失败", state="error")
+                            error_msg = str(e)
+                            if '402' in error_msg or 'Insufficient Balance' in error_msg:
+                                st.error("分析失败: OpenAI API 余额不足，请充值或检查API密钥")
+                            else:
+                                st.error(f"分析失败: {error_msg}")
+
+            st.caption(f"结果缓存：命中 {QUERY_CACHE.hits} 次 / 未命中 {QUERY_CACHE.misses} 次 ｜ "
+                       f"快速通道：{PLANNER_STATS.fast_path}/{PLANNER_STATS.total}（{PLANNER_STATS.hit_rate:.0%}）")
+
+        with tab2:
+            st.markdown("### 交互式数据可视化")
+            if st.session_state['df'] is not None:
+                # 获取数值列和非数值列
+                numeric_cols = st.session_state['df'].select_dtypes(include=['number']).columns.tolist()
+                other_cols = [col for col in st.session_state['df'].columns if col not in numeric_cols]
+
+                # 确保有足够的列进行可视化
+                if len(numeric_cols) == 0:
+                    st.warning("数据中没有数值列，无法进行可视化分析")
+                elif len(other_cols) == 0:
+                    st.warning("数据中没有分类列，无法进行分组可视化")
+                else:
+                    # 图表类型选择
+                    chart_options = ["柱状图", "折线图", "散点图", "饼图"]
+                    chart_type = st.selectbox("选择图表类型", chart_options, index=0)
+
+                    # 列选择器
+                    col1, col2 = st.columns(2)
+
+                    with col1:
+                        # X轴选择（分类数据）
+                        x_options = other_cols if other_cols else st.session_state['df'].columns
+                        # 散点图需要数值型X轴
+                        if chart_type == "散点图":
+                            x_options = numeric_cols
+                        x_col = st.selectbox("选择X轴（分类数据）",
+                                             options=x_options,
+                                             index=0 if len(x_options) > 0 else None,
+                                             help="选择包含类别信息的列")
+
+                        # 添加X轴标签设置
+                        x_label = st.text_input("X轴标签:", value=x_col if x_col else "",
+                                                help="自定义X轴显示文字")
+
+                    with col2:
+                        # Y轴选择（数值数据）
+                        y_cols = st.multiselect("选择Y轴（数值数据）",
+                                                options=numeric_cols,
+                                                default=[numeric_cols[0]] if numeric_cols else None,
+                                                help="选择一个或多个数值列")
+
+                        # 添加Y轴标签设置
+                        y_label = st.text_input("Y轴标签:", value="数值" if y_cols else "",
+                                                help="自定义Y轴显示文字")
+
+                    # 分组变量（仅适用于柱状图和折线图）
+                    if chart_type in ["柱状图", "折线图"] and other_cols:
+                        hue_col = st.selectbox("分组变量（可选）",
+                                               options=["无"] + other_cols,
+                                               index=0,
+                                               help="根据类别分组显示数据")
+                        hue_col = None if hue_col == "无" else hue_col
+                    else:
+                        hue_col = None
+
+                    # 聚合方式和置信区间（仅适用于柱状图和折线图）
+                    if chart_type in ["柱状图", "折线图"]:
+                        agg_col, ci_col = st.columns(2)
+                        with agg_col:
+                            agg_label = st.selectbox("聚合方式", list(AGG_FUNCS), index=0,
+                                                     help="先按X轴（和分组变量）聚合，只绘制聚合后的结果")
+                        with ci_col:
+                            show_ci = st.checkbox("显示95%置信区间", value=False,
+                                                  help="用解析公式计算置信区间，不做重采样")
+                    else:
+                        agg_label, show_ci = "平均值", False
+
+                    # 大数据量折线/散点自动降采样
+                    if chart_type in ["折线图", "散点图"]:
+                        sample_col, mode_col = st.columns(2)
+                        with sample_col:
+                            max_points = st.number_input("降采样阈值（点数）", min_value=100,
+                                                         value=DOWNSAMPLE_THRESHOLD, step=1000,
+                                                         help="超过该点数时折线使用LTTB降采样，散点使用二维分箱")
+                        with mode_col:
+                            # DuckDB表只能把网格分箱下推到引擎中执行
+                            bin_modes = list(SCATTER_BIN_MODES) if st.session_state['table'] is None else ["网格分箱"]
+                            bin_mode = st.radio("密集散点显示方式", bin_modes,
+                                                horizontal=True) if chart_type == "散点图" else None
+                    else:
+                        max_points, bin_mode = DOWNSAMPLE_THRESHOLD, None
+
+                    chart_background = st.checkbox("后台生成", key="chart_background",
+                                                   help="在后台进程中渲染图表，不阻塞页面")
+
+                    # 图表生成按钮
+                    if st.button("生成图表", key="generate_chart"):
+                        chart_spec = {
+                            'chart_type': chart_type, 'x_col': x_col, 'y_cols': y_cols,
+                            'hue_col': hue_col, 'x_label': x_label, 'y_label': y_label,
+                            'agg': AGG_FUNCS[agg_label], 'ci': show_ci, 'max_points': max_points,
+                            'bin_mode': SCATTER_BIN_MODES[bin_mode] if bin_mode else None,
+                        }
+                        dataset_key = st.session_state.get('dataset_key')
+
+                        def load_plot_data():
+                            # 只投影图表用到的列；数据集在会话之间共享，不在原数据上做类型转换
+                            if st.session_state['table'] is not None:
+                                # DuckDB表：聚合和分箱下推到DuckDB执行
+                                return st.session_state['table']
+                            plot_data = None
+                            if dataset_key:
+                                plot_data = load_columns(dataset_key, chart_columns(chart_spec))
+                            if plot_data is None:
+                                plot_data = st.session_state['df'][chart_columns(chart_spec)]
+                            return plot_data
+
+                        if not y_cols:
+                            st.warning("请至少选择一个Y轴数据列")
+                        elif chart_background:
+                            # 数据集已落盘时子进程自行内存映射读取，DuckDB表只传递文件路径，否则只传递投影后的列
+                            job = SCHEDULER.submit(st.session_state['session_id'], "chart",
+                                                   f"{chart_type}: {x_col} vs {', '.join(y_cols)}",
+                                                   render_chart_job, dataset_key, chart_spec,
+                                                   None if dataset_key in DATASET_STORE else load_plot_data(),
+                                                   cpu=True)
+                            st.success(f"已提交后台任务 #{job.id}，可在下方任务列表查看进度")
+                        else:
+                            with st.spinner("正在生成图表..."):
+                                try:
+                                    # 创建图表容器
+                                    with st.container(), trace("chart", chart_type=chart_type,
+                                                               engine="duckdb" if st.session_state['table'] is not None
+                                                               else "pandas"):
+                                        st.markdown("#### 数据可视化结果")
+                                        # 相同数据集和图表规格直接复用已渲染的图片
+                                        chart = cached_render_chart(dataset_key, load_plot_data, chart_spec)
+                                        for warning in chart['warnings']:
+                                            st.warning(warning)
+
+                                        # 显示图表
+                                        with span("display", image_bytes=len(chart['image'])):
+                                            st.image(chart['image'], use_container_width=True)
+                                        if chart['shown_points'] is not None:
+                                            if chart['binned']:
+                                                st.caption(f"共 {chart['total_rows']:,} 个数据点，"
+                                                           f"已聚合为 {chart['shown_points']:,} 个{bin_mode[:-2]}分箱")
+                                            else:
+                                                st.caption(f"显示 {chart['shown_points']:,} 个点 / "
+                                                           f"共 {chart['total_rows']:,} 行数据")
+
+                                        # 添加数据洞察
+                                        if x_col and y_cols:
+                                            with st.container():
+                                                st.markdown("##### 数据洞察", unsafe_allow_html=True)
+                                                insight_text = ""
+
+                                                if chart_type == "柱状图":
+                                                    insight_text = f"此柱状图展示了不同 **{x_col}** 类别的 **{', '.join(y_cols)}** 值分布"
+                                                elif chart_type == "折线图":
+                                                    insight_text = f"此折线图展示了 **{', '.join(y_cols)}** 随时间或类别的变化趋势"
+                                                elif chart_type == "散点图":
+                                                    insight_text = f"此散点图展示了 **{x_col}** 与 **{y_cols[0]}** 之间的关系"
+                                                elif chart_type == "饼图":
+                                                    insight_text = f"此饼图展示了不同 **{x_col}** 类别在 **{y_cols[0]}** 中的占比"
+
+                                                if insight_text:
+                                                    st.markdown(f'<div class="data-insight">{insight_text}</div>',
+                                                                unsafe_allow_html=True)
+
+                                except Exception as e:
+                                    st.error(f"图表生成失败: {str(e)}")
+
+    # 后台任务列表
+    if st.session_state.get('data_loaded', False):
+        with st.expander("🗂 后台任务", expanded=True):
+            job_panel()
+
+# ==================== AI聊天功能 ====================
+elif function_selector == "AI聊天":
+    # AI聊天功能
+    st.subheader("💬 AI聊天助手")
+
+    if not st.session_state['API_KEY']:
+        st.warning('请先在侧边栏输入OpenAI API Key！')
+
+    with st.sidebar:
+        memory_tokens = st.number_input("对话记忆上限（tokens）", min_value=200, max_value=32000,
+                                        value=CHAT_MEMORY_TOKENS, step=500,
+                                        help="最近的对话原样保留，超出部分自动合并为摘要，保持每轮提示词长度稳定")
+        if st.session_state.get('chat_usage'):
+            last_turn = st.session_state['chat_usage'][-1]
+            st.caption(f"上一轮：提示词 {last_turn['prompt_tokens']} tokens，回复 {last_turn['completion_tokens']} tokens"
+                       f"（共 {len(st.session_state['chat_usage'])} 轮）")
+
+    # 显示聊天历史
+    for message in st.session_state['messages']:
+        with st.chat_message(message['role']):
+            st.markdown(message['content'])
+
+    # 处理用户输入
+    if prompt := st.chat_input("输入您的问题..."):
+        if not st.session_state['API_KEY']:
+            st.info('请先输入OpenAI API Key！')
+            st.stop()
+
+        # 添加用户消息
+        st.session_state['messages'].append({'role': 'human', 'content': prompt})
+
+        # 实时显示用户消息
+        with st.chat_message("human"):
+            st.markdown(prompt)
+
+        try:
+            # 复用共享的AI模型和连接池
+            model = get_chat_model(st.session_state['API_KEY'], st.session_state['BASE_URL'], 'gpt-4')
+
+            # 超出token预算的早期对话由较小的模型增量合并为摘要
+            summary_model = get_chat_model(st.session_state['API_KEY'], st.session_state['BASE_URL'], 'gpt-4o-mini',
+                                           temperature=0)
+            if st.session_state.get('memory') is None:
+                st.session_state['memory'] = build_chat_memory(summary_model, memory_tokens)
+            st.session_state['memory'].llm = summary_model
+            st.session_state['memory'].max_token_limit = memory_tokens
+
+            # 逐个token实时显示AI响应；生成过程中点击停止会中断本次运行，已生成的部分会保留
+            reply_parts = []
+
+            def reply_stream():
+                for token in stream_chat_reply(model, st.session_state['memory'], prompt,
+                                               usage=st.session_state.setdefault('chat_usage', [])):
+                    reply_parts.append(token)
+                    yield token
+
+            with st.chat_message("ai"):
+                st.button("⏹ 停止生成", key="stop_chat")
+                stopped = True
+                try:
+                    st.write_stream(reply_stream())
+                    stopped = False
+                finally:
+                    # 添加AI响应（包括被中途停止时已生成的部分）
+                    if reply_parts:
+                        response = "".join(reply_parts)
+                        if stopped:
+                            response += "\n\n*（已停止生成）*"
+                        st.session_state['messages'].append({'role': 'ai', 'content': response})
+
+        except Exception as e:
+            error_msg = str(e)
+            if '402' in error_msg or 'Insufficient Balance' in error_msg:
+                st.error("聊天失败: OpenAI API 余额不足，请充值或检查API密钥")
+            else:
+                st.error(f"聊天出错: {error_msg}")
+
+# ==================== 性能诊断 ====================
+# 放在页面最后渲染，包含本次运行中刚完成的操作
+with st.sidebar:
+    st.markdown("---")
+    if st.checkbox("显示性能诊断", key="show_diagnostics",
+                   help="各阶段耗时、token用量、内存和缓存命中率；完整记录同时写入JSONL日志"):
+        show_diagnostics()
@@ -0,0 +1,195 @@
+"""本地OpenAI兼容模拟接口：按脚本返回回复，可注入延迟，用于离线测试和基准测试
+
+    python mock_server.py --port 8765 --latency 0.3 --token-delay 0.01
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 streamlit run main.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 默认脚本：智能体按步骤调用工具（先查看数据再提交结果），聊天返回固定回复
+DEFAULT_SCRIPT = {
+    "agent_steps": [
+        {"python_repl_ast": "df.shape", "sql_db_query": "SELECT count(*) AS n FROM data"},
+        {"python_repl_ast": "df.describe()", "sql_db_query": "SELECT * FROM data LIMIT 5"},
+    ],
+    "result": {"answer": "模拟结果"},
+    "chat_reply": "你好，我是小美，这是一条模拟回复。",
+}
+
+
+def _tool_names(body):
+    return [tool["function"]["name"] for tool in body.get("tools", [])]
+
+
+def _react_tool(prompt):
+    for name in ("python_repl_ast", "sql_db_query"):
+        if name in prompt:
+            return name
+    return None
+
+
+def plan_reply(body, script):
+    """根据请求内容决定回复：返回 (文本, 工具调用或None)
+
+    - 带 tools 的请求（工具调用智能体）：按已完成的工具调用次数依次执行 agent_steps，最后调用 submit_result
+    - ReAct 提示词（包含工具名）：按 Observation 的次数依次输出 Action，最后输出 Final Answer
+    - 其他请求视为聊天
+    """
+    messages = body.get("messages", [])
+    result = json.dumps(script["result"], ensure_ascii=False)
+    tools = _tool_names(body)
+    if tools:
+        step = sum(1 for m in messages if m.get("role") == "tool")
+        query_tool = next((name for name in tools if name != "submit_result"), None)
+        if step < len(script["agent_steps"]) and query_tool:
+            arguments = {"query": script["agent_steps"][step].get(query_tool, "")}
+            return f"第{step + 1}步：查看数据", {"name": query_tool, "arguments": json.dumps(arguments)}
+        if "submit_result" in tools:
+            return "", {"name": "submit_result", "arguments": result}
+        return result, None
+
+    prompt = "\n".join(str(m.get("content", "")) for m in messages)
+    tool = _react_tool(prompt)
+    if tool:
+        step = prompt.count("Observation:") - prompt.count("Observation: the result of the action")
+        if step < len(script["agent_steps"]):
+            return (f"Thought: 第{step + 1}步，先查看数据\nAction: {tool}\n"
+                    f"Action Input: {script['agent_steps'][step].get(tool, '')}"), None
+        return f"Thought: 已得到结果\nFinal Answer: {result}", None
+    return script["chat_reply"], None
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # 由 make_server 设置：脚本、固定延迟、随机抖动、每个流式片段的间隔，以及返回429限流的概率
+    script = DEFAULT_SCRIPT
+    latency = 0.0
+    jitter = 0.0
+    token_delay = 0.0
+    rate_limit = 0.0
+    requests = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json({"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        else:
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json({"error": {"message": "not found"}}, 404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        type(self).requests += 1
+        if random.random() < self.rate_limit:
+            self._send_json({"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}, 429,
+                            {"Retry-After": "0.1"})
+            return
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        content, tool_call = plan_reply(body, self.script)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        usage = {"prompt_tokens": len(json.dumps(body.get("messages", []), ensure_ascii=False)) // 3,
+                 "completion_tokens": max(1, len(content) // 3)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        tool_calls = None
+        if tool_call:
+            tool_calls = [{"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function", "function": tool_call}]
+
+        if body.get("stream"):
+            self._stream(body["model"], completion_id, content, tool_calls)
+            return
+        message = {"role": "assistant", "content": content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        self._send_json({
+            "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": usage,
+        })
+
+    def _stream(self, model, completion_id, content, tool_calls):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def send(delta, finish_reason=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.flush()
+
+        try:
+            send({"role": "assistant", "content": ""})
+            # 每个片段2个字符，片段之间按 token_delay 间隔发送
+            for i in range(0, len(content), 2):
+                send({"content": content[i:i + 2]})
+                time.sleep(self.token_delay)
+            if tool_calls:
+                send({"tool_calls": [dict(call, index=i) for i, call in enumerate(tool_calls)]})
+            send({}, "tool_calls" if tool_calls else "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途断开（如用户停止生成），不再继续发送
+            self.close_connection = True
+
+
+def make_server(host="127.0.0.1", port=0, script=None, latency=0.0, jitter=0.0, token_delay=0.0, rate_limit=0.0):
+    """创建模拟接口服务；port=0 时自动分配端口，地址为 http://host:server.server_port/v1"""
+    handler = type("ScriptedHandler", (MockHandler,), {
+        "script": dict(DEFAULT_SCRIPT, **(script or {})),
+        "latency": latency, "jitter": jitter, "token_delay": token_delay, "rate_limit": rate_limit,
+    })
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def start_server(**kwargs):
+    """在后台线程中启动模拟接口，返回 (server, base_url)"""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地OpenAI兼容模拟接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的固定延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机抖动范围（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="流式输出每个片段的间隔（秒）")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="以该概率返回429限流错误，用于测试重试")
+    parser.add_argument("--script", help="JSON脚本文件，可覆盖 agent_steps / result / chat_reply")
+    args = parser.parse_args()
+
+    script = None
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            script = json.load(f)
+    server = make_server(args.host, args.port, script, args.latency, args.jitter, args.token_delay, args.rate_limit)
+    print(f"Mock OpenAI server listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import json
+import re
+import threading
+import unicodedata
+from functools import partial
+
+import pandas as pd
+
+from dataset import derived_column
+
+# 筛选结果最多返回的行数
+FILTER_MAX_ROWS = 100
+
+_CN_DIGITS = {"一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10}
+
+_AGG_WORDS = [
+    ("平均值", "mean"), ("平均数", "mean"), ("平均", "mean"), ("均值", "mean"), ("average", "mean"), ("mean", "mean"),
+    ("总和", "sum"), ("合计", "sum"), ("总计", "sum"), ("求和", "sum"), ("总额", "sum"), ("总", "sum"),
+    ("sum", "sum"), ("total", "sum"),
+    ("数量", "count"), ("个数", "count"), ("计数", "count"), ("次数", "count"), ("count", "count"),
+    ("最大值", "max"), ("最大", "max"), ("最高", "max"), ("max", "max"),
+    ("最小值", "min"), ("最小", "min"), ("最低", "min"), ("min", "min"),
+    ("中位数", "median"), ("median", "median"),
+]
+_AGG_LABELS = {"mean": "平均值", "sum": "总和", "count": "数量", "max": "最大值", "min": "最小值", "median": "中位数"}
+_AGG_RE = re.compile("|".join(re.escape(word) for word, _ in _AGG_WORDS))
+
+_TOKEN_RE = re.compile(r"<c(\d+)>")
+_TOP_N_RE = re.compile(r"(?P<dir>最高|最大|最多|最低|最小|最少|排名前|前|后|top|bottom)\s*的?\s*"
+                       r"(?P<n>\d+|[一二两三四五六七八九十])\s*(?:个|名|条|行|位|项|家|种)?")
+_GROUP_RE = re.compile(r"(?:各个|各|每一个|每个|每|按照|按|by|per|each)\s*(?P<group><c\d+>)")
+_FILTER_RE = re.compile(r"(?P<col><c\d+>)\s*(?P<op>大于等于|小于等于|不低于|不高于|不少于|不超过|大于|高于|超过|多于|"
+                        r"小于|低于|少于|等于|>=|<=|==|!=|>|<|=|为|是)\s*"
+                        r"['\"“”‘’]?(?P<value>-?\d+(?:\.\d+)?|[^'\"“”‘’的\s<>]+?)['\"“”‘’]?(?=的|\s|$)")
+_ROW_COUNT_RE = re.compile(r"有?(?:多少|几)(?:行|条)(?:数据|记录)?|行数|记录数|数据量|how many rows")
+_DISTINCT_RE = re.compile(r"有?(?:多少|几)(?:种|个不同|类)|不同(?:的)?(?:取值|值)?(?:数量|个数)")
+
+_OPS = {
+    "大于等于": "ge", "不低于": "ge", "不少于": "ge", ">=": "ge",
+    "小于等于": "le", "不高于": "le", "不超过": "le", "<=": "le",
+    "大于": "gt", "高于": "gt", "超过": "gt", "多于": "gt", ">": "gt",
+    "小于": "lt", "低于": "lt", "少于": "lt", "<": "lt",
+    "等于": "eq", "==": "eq", "=": "eq", "为": "eq", "是": "eq", "!=": "ne",
+}
+
+# 不影响语义的填充词；识别出的模式和列名之外只剩这些词时才走快速通道。
+# "多少"、"有"、"个" 会改变问题的含义（"大于100的产品有多少个" 问的是数量），不作为填充词，计数只由 _plan_count 识别
+_FILLERS = sorted([
+    "请", "帮我", "帮忙", "一下", "显示", "列出", "找出", "查询", "查看", "看看", "给出", "返回", "列举", "告诉我",
+    "计算", "统计", "求", "是", "的", "条", "名", "行", "位", "项", "家", "种", "哪些", "有哪些", "什么", "是多少",
+    "分别", "数据", "所有", "记录", "中", "里", "排名", "排序", "分组", "对应", "及其", "和", "以及", "值",
+    "共", "总共", "一共", "数据集", "表格", "表", "取值", "不同",
+    "show", "list", "the", "of", "by", "each", "per", "what", "is", "are", "rows", "values", "with", "and",
+], key=len, reverse=True)
+
+
+class PlannerStats:
+    """统计快速通道命中占比（进程内所有会话共享）"""
+
+    def __init__(self):
+        self.fast_path = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit):
+        with self._lock:
+            self.total += 1
+            self.fast_path += int(hit)
+
+    @property
+    def hit_rate(self):
+        return self.fast_path / self.total if self.total else 0.0
+
+
+PLANNER_STATS = PlannerStats()
+
+
+def _tag_columns(df, query):
+    # 把问题中出现的列名替换为 <cN> 标记，长列名优先，避免"销售额"被"销售"截断
+    text = unicodedata.normalize("NFKC", query).strip().lower()
+    text = re.sub(r"[，,。？?！!；;：:\s]+", " ", text).strip()
+    columns = []
+    for col in sorted(df.columns, key=lambda c: len(str(c)), reverse=True):
+        name = str(col).lower()
+        if name and name in text:
+            text = text.replace(name, f"<c{len(columns)}>")
+            columns.append(col)
+    return text, columns
+
+
+def _tokens(text, columns):
+    return [columns[int(i)] for i in _TOKEN_RE.findall(text)]
+
+
+def _only_fillers(text):
+    text = _TOKEN_RE.sub("", text)
+    for word in _FILLERS:
+        text = text.replace(word, "")
+    return not re.sub(r"[\s\d'\"“”‘’()（）]+", "", text)
+
+
+def _to_int(value):
+    return int(value) if value.isdigit() else _CN_DIGITS.get(value)
+
+
+def _is_numeric(df, col):
+    return pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])
+
+
+def _table(frame):
+    # 通过 to_json 统一转换为JSON原生类型（日期为ISO字符串），与智能体输出的表格格式一致
+    table = json.loads(frame.to_json(orient="split", index=False, force_ascii=False, date_format="iso"))
+    return {"table": {"columns": [str(c) for c in table["columns"]], "data": table["data"]}}
+
+
+def _format_number(value):
+    if pd.isna(value):
+        return "无"
+    if float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+
+def _plan_top_n(df, text, columns):
+    match = _TOP_N_RE.search(text)
+    if not match:
+        return None
+    n = _to_int(match.group("n"))
+    rest = text[:match.start()] + " " + text[match.end():]
+    # 只有问题中出现求和词（"销售额总和最高的3个产品"）时才按标签汇总，平均价、成本等不可相加的指标按行排名
+    agg_match = _AGG_RE.search(rest)
+    summed = agg_match is not None and dict(_AGG_WORDS)[agg_match.group(0)] == "sum"
+    if summed:
+        rest = rest[:agg_match.start()] + " " + rest[agg_match.end():]
+    tokens = _tokens(text, columns)
+    values = [c for c in tokens if _is_numeric(df, c)]
+    labels = [c for c in tokens if not _is_numeric(df, c)]
+    if not n or len(values) > 1 or len(labels) > 1 or not _only_fillers(rest):
+        return None
+
+    ascending = match.group("dir") in ("最低", "最小", "最少", "后", "bottom")
+    if not values:
+        # "前N行"：没有排序列时按原始顺序取行
+        if labels or match.group("dir") not in ("前", "排名前", "top"):
+            return None
+        return _table(df.head(n))
+
+    value = values[0]
+    if summed:
+        if not labels:
+            return None
+        ranked = df.groupby(labels[0], observed=True)[value].sum()
+        ranked = ranked.nsmallest(n) if ascending else ranked.nlargest(n)
+        return _table(ranked.reset_index())
+    ranked = df.nsmallest(n, value) if ascending else df.nlargest(n, value)
+    if labels and not ranked[labels[0]].is_unique:
+        # 前N行中标签有重复（如明细数据中的产品），不确定是否应当汇总，交给智能体
+        return None
+    return _table(ranked[labels + [value]] if labels else ranked)
+
+
+def _plan_group_agg(df, text, columns):
+    group_match = _GROUP_RE.search(text)
+    if not group_match:
+        return None
+    rest = text[:group_match.start()] + " " + text[group_match.end():]
+    agg_match = _AGG_RE.search(rest)
+    if not agg_match:
+        return None
+    agg = dict(_AGG_WORDS)[agg_match.group(0)]
+    rest = rest[:agg_match.start()] + " " + rest[agg_match.end():]
+
+    group = columns[int(_TOKEN_RE.search(group_match.group("group")).group(1))]
+    values = _tokens(rest, columns)
+    if not _only_fillers(rest) or len(values) > 1:
+        return None
+    if not values:
+        if agg != "count":
+            return None
+        result = df.groupby(group, observed=True).size().rename("数量")
+        return _table(result.reset_index())
+    value = values[0]
+    if agg != "count" and not _is_numeric(df, value):
+        return None
+    if agg == "count" and not _is_numeric(df, value):
+        # "各地区的产品数量" 问的是不同产品的个数，不是行数
+        agg = "nunique"
+    result = df.groupby(group, observed=True)[value].agg(agg).rename(f"{value}{_AGG_LABELS.get(agg, '数量')}")
+    return _table(result.reset_index())
+
+
+def _lower_text(series):
+    return series.astype(str).str.lower()
+
+
+def _plan_filter(df, text, columns, dataset_key=None):
+    match = _FILTER_RE.search(text)
+    if not match:
+        return None
+    col = columns[int(_TOKEN_RE.search(match.group("col")).group(1))]
+    op, raw = _OPS[match.group("op")], match.group("value")
+    rest = text[:match.start()] + " " + text[match.end():]
+    if not _only_fillers(rest):
+        return None
+
+    if _is_numeric(df, col):
+        try:
+            value = float(raw)
+        except ValueError:
+            return None
+    elif op in ("eq", "ne"):
+        value = raw
+        # 转换后的文本列按数据集缓存，重复筛选同一列时不再整列转换
+        series = derived_column(dataset_key, df, col, "lower", _lower_text)
+        mask = series == value if op == "eq" else series != value
+        if op == "eq" and not mask.any():
+            # 取值在数据中不存在，可能是理解错了问题，交给智能体
+            return None
+    else:
+        return None
+
+    if _is_numeric(df, col):
+        mask = getattr(df[col], op)(value)
+    shown = [c for c in _tokens(rest, columns) if c != col]
+    result = df.loc[mask, [col] + shown if shown else df.columns]
+    return _table(result.head(FILTER_MAX_ROWS))
+
+
+def _plan_scalar_agg(df, text, columns):
+    agg_match = _AGG_RE.search(text)
+    tokens = _tokens(text, columns)
+    if not agg_match or len(tokens) != 1:
+        return None
+    rest = text[:agg_match.start()] + " " + text[agg_match.end():]
+    if not _only_fillers(rest):
+        return None
+    agg, col = dict(_AGG_WORDS)[agg_match.group(0)], tokens[0]
+    if not _is_numeric(df, col):
+        # 文本列的 "个数" 指不同取值的个数（"地区的个数"），与 _plan_count 的回答一致
+        if agg != "count":
+            return None
+        return {"answer": f"{col}共有{df[col].nunique()}种不同取值"}
+    return {"answer": f"{col}的{_AGG_LABELS[agg]}为{_format_number(df[col].agg(agg))}"}
+
+
+def _plan_count(df, text, columns):
+    tokens = _tokens(text, columns)
+    distinct = _DISTINCT_RE.search(text)
+    if distinct and len(tokens) == 1:
+        rest = text[:distinct.start()] + " " + text[distinct.end():]
+        if _only_fillers(rest):
+            return {"answer": f"{tokens[0]}共有{df[tokens[0]].nunique()}种不同取值"}
+    row_count = _ROW_COUNT_RE.search(text)
+    if row_count and not tokens:
+        rest = text[:row_count.start()] + " " + text[row_count.end():]
+        if _only_fillers(rest):
+            return {"answer": f"共有{len(df):,}行数据"}
+    return None
+
+
+def plan_query(df, query, dataset_key=None):
+    """识别常见的排名/分组聚合/筛选/计数问题并直接用pandas计算
+
+    返回与智能体相同的 {"answer": ...} 或 {"table": {...}} 结构；无法确定语义时返回None，交给智能体处理。
+    传入 dataset_key 时，筛选用到的派生列按数据集缓存。
+    """
+    text, columns = _tag_columns(df, query)
+    for plan in (_plan_top_n, _plan_group_agg, partial(_plan_filter, dataset_key=dataset_key), _plan_count,
+                 _plan_scalar_agg):
+        try:
+            result = plan(df, text, columns)
+        except (TypeError, ValueError, KeyError):
+            result = None
+        if result is not None:
+            return result
+    return None
@@ -0,0 +1,120 @@
+import json
+import os
+
+import pandas as pd
+
+from dataset import LRUCache
+from duckdb_backend import DuckTable, quote
+from tracing import register_cache, span
+
+# 数据集概况缓存（按数据集键），每个数据集只统计一次
+PROFILE_CACHE = register_cache("profile", LRUCache(int(os.getenv("PROFILE_CACHE_ENTRIES", "256")),
+                                                  sizeof=lambda profile: 1))
+# 每列记录的常见值个数、样例行数；写入提示词时最多列出的列数和单个取值的最大长度
+PROFILE_TOP_VALUES = 3
+PROFILE_SAMPLE_ROWS = 3
+PROFILE_MAX_COLUMNS = 60
+PROFILE_VALUE_CHARS = 30
+
+
+def _display(value):
+    if value is None or (not isinstance(value, (list, tuple)) and pd.isna(value)):
+        return None
+    if isinstance(value, float):
+        return round(value, 4)
+    if hasattr(value, "item"):
+        value = value.item()
+    return value if isinstance(value, (int, float, bool)) else str(value)
+
+
+def _sample_rows(frame):
+    table = json.loads(frame.to_json(orient="split", index=False, force_ascii=False, date_format="iso"))
+    return table["data"]
+
+
+def _profile_frame(df):
+    rows = len(df)
+    null_rates = df.isna().mean() if rows else pd.Series(0.0, index=df.columns)
+    nunique = df.nunique()
+    ranged = df.select_dtypes(include=["number", "datetime", "datetimetz"]).columns
+    ranged = [c for c in ranged if not pd.api.types.is_bool_dtype(df[c])]
+    mins, maxs = df[ranged].min(), df[ranged].max()
+
+    columns = []
+    for col in df.columns:
+        info = {"name": str(col), "dtype": str(df[col].dtype), "nunique": int(nunique[col]),
+                "null_rate": float(null_rates[col])}
+        if col in ranged:
+            info["min"], info["max"] = _display(mins[col]), _display(maxs[col])
+        else:
+            top = df[col].value_counts(sort=True).head(PROFILE_TOP_VALUES)
+            info["top"] = [[_display(value), int(count)] for value, count in top.items()]
+        columns.append(info)
+    return rows, columns, _sample_rows(df.head(PROFILE_SAMPLE_ROWS))
+
+
+def _profile_duck(table):
+    # SUMMARIZE 一次扫描得到每列的类型、范围、近似不同值数和缺失率
+    summary = table.query(f"SUMMARIZE SELECT * FROM {table.source}")
+    dtypes = table.dtypes
+    rows = len(table)
+    columns = []
+    for _, item in summary.iterrows():
+        col = item["column_name"]
+        info = {"name": str(col), "dtype": str(dtypes[col]), "nunique": int(item["approx_unique"]),
+                "null_rate": float(item["null_percentage"]) / 100}
+        ranged = pd.api.types.is_numeric_dtype(dtypes[col]) or pd.api.types.is_datetime64_any_dtype(dtypes[col])
+        if ranged and not pd.api.types.is_bool_dtype(dtypes[col]):
+            info["min"], info["max"] = _display(item["min"]), _display(item["max"])
+        else:
+            top = table.query(f"SELECT {quote(col)} AS value, count(*) AS n FROM {table.source} "
+                              f"WHERE {quote(col)} IS NOT NULL GROUP BY 1 ORDER BY 2 DESC "
+                              f"LIMIT {PROFILE_TOP_VALUES}")
+            info["top"] = [[_display(value), int(count)] for value, count in zip(top["value"], top["n"])]
+        columns.append(info)
+    return rows, columns, _sample_rows(table.head(PROFILE_SAMPLE_ROWS))
+
+
+def profile_dataset(df):
+    """统计数据集概况：行数、每列的类型/不同值数/缺失率/范围或常见值，以及样例行
+
+    返回 {"rows", "columns": [...], "dtype_counts": {类型: 列数}, "sample": [[...], ...]}。
+    """
+    rows, columns, sample = _profile_duck(df) if isinstance(df, DuckTable) else _profile_frame(df)
+    dtype_counts = pd.Series([c["dtype"] for c in columns], dtype="object").value_counts()
+    return {
+        "rows": rows,
+        "columns": columns,
+        "dtype_counts": {str(k): int(v) for k, v in dtype_counts.items()},
+        "sample": sample,
+    }
+
+
+def cached_profile(key, df):
+    with span("profile"):
+        if key is None:
+            return profile_dataset(df)
+        return PROFILE_CACHE.get_or_load(key, lambda: profile_dataset(df))
+
+
+def _short(value):
+    text = str(value)
+    return text if len(text) <= PROFILE_VALUE_CHARS else text[:PROFILE_VALUE_CHARS] + "…"
+
+
+def format_profile(profile):
+    """把概况压缩成写入提示词的文本：每列一行，加上几行样例"""
+    lines = [f"共{profile['rows']:,}行 × {len(profile['columns'])}列，"
+             f"各列为：列名 | 类型 | 不同值数 | 缺失率 | 范围或常见值(次数)"]
+    for info in profile["columns"][:PROFILE_MAX_COLUMNS]:
+        if "top" in info:
+            detail = ", ".join(f"{_short(value)}({count})" for value, count in info["top"])
+        else:
+            detail = f"{_short(info['min'])} ~ {_short(info['max'])}"
+        lines.append(f"- {info['name']} | {info['dtype']} | {info['nunique']:,} | {info['null_rate']:.0%} | {detail}")
+    if len(profile["columns"]) > PROFILE_MAX_COLUMNS:
+        lines.append(f"- ……其余{len(profile['columns']) - PROFILE_MAX_COLUMNS}列省略")
+    lines.append(f"前{len(profile['sample'])}行样例：")
+    lines.extend(json.dumps([_short(v) if isinstance(v, str) else v for v in row], ensure_ascii=False)
+                 for row in profile["sample"])
+    return "\n".join(lines)
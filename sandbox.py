@@ -0,0 +1,221 @@
+import math
+import multiprocessing
+import os
+import signal
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Type
+
+from langchain_core.tools import BaseTool
+from pydantic import Field
+from langchain_experimental.tools.python.tool import PythonAstREPLTool, PythonInputs
+
+from dataset import DATASET_STORE
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 执行智能体生成代码的子进程数；每次工具调用的CPU时间（秒）、内存增量（MB）和墙钟超时（秒）
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "30"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "2048"))
+SANDBOX_TIMEOUT = int(os.getenv("SANDBOX_TIMEOUT", "60"))
+# 每个子进程保留的变量空间数（每个智能体一个），超出时淘汰最久未使用的
+SANDBOX_NAMESPACES = 8
+
+
+def _on_cpu_limit(signum, frame):
+    raise TimeoutError(f"代码执行超过CPU时间限制（{SANDBOX_CPU_SECONDS}秒）")
+
+
+def _address_space():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _set_limits():
+    # 只调整软限制，硬限制保持不变，下一次调用还能重新设置；这是资源隔离，不是安全隔离
+    if resource is None:
+        return
+    used = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = math.ceil(used.ru_utime + used.ru_stime) + SANDBOX_CPU_SECONDS
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+    try:
+        memory = _address_space() + SANDBOX_MEMORY_MB * 1024 * 1024
+    except OSError:
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (memory, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+
+def _clear_limits():
+    if resource is None:
+        return
+    for limit in (resource.RLIMIT_CPU, resource.RLIMIT_AS):
+        resource.setrlimit(limit, (resource.getrlimit(limit)[1], resource.getrlimit(limit)[1]))
+
+
+def _worker_main(conn):
+    """子进程主循环：按数据集键内存映射读取DataFrame，在各智能体自己的变量空间中执行代码"""
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    frames = OrderedDict()
+    tools = OrderedDict()
+    while True:
+        try:
+            session, key, code = conn.recv()
+        except EOFError:
+            return
+        try:
+            if key not in frames:
+                frames[key] = DATASET_STORE.load(key)
+                while len(frames) > 2:
+                    frames.popitem(last=False)
+            frames.move_to_end(key)
+            if session not in tools:
+                # 复用 PythonAstREPLTool 的解析和执行逻辑，行为与进程内执行一致；
+                # 每个变量空间拿到各自的浅拷贝，写时复制保证一个会话对 df 的修改不影响其他会话
+                tools[session] = PythonAstREPLTool(locals={"df": frames[key].copy(deep=False)})
+                while len(tools) > SANDBOX_NAMESPACES:
+                    tools.popitem(last=False)
+            tools.move_to_end(session)
+
+            tool = tools[session]
+            _set_limits()
+            try:
+                output = tool._run(code)
+            finally:
+                _clear_limits()
+            output = str(output)
+        except Exception as e:
+            output = f"{type(e).__name__}: {str(e)}"
+        conn.send(output)
+
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def run(self, session, key, code, timeout):
+        self.conn.send((session, key, code))
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"代码执行超过{timeout}秒被终止")
+        return self.conn.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    """在子进程中执行智能体生成的代码，慢查询不会阻塞Streamlit服务进程
+
+    子进程按需创建（spawn），数据集通过列式存储内存映射读取，不随每次调用传输。
+    同一个智能体始终在同一个子进程中执行，以保留之前步骤中定义的变量；超时的子进程直接结束并在下次按需重建，
+    其中的变量空间随之丢失。
+    """
+
+    def __init__(self, max_workers, timeout):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = []
+        self._affinity = {}
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self, session):
+        # 已有变量空间的会话只在自己的子进程上执行，忙时等待，换到其他子进程会丢失之前定义的变量；
+        # 新会话依次选择：没有会话使用的空闲子进程、新建子进程、使用会话最少的空闲子进程
+        with self._cond:
+            while True:
+                preferred = self._affinity.get(session)
+                if preferred is not None:
+                    if preferred in self._idle:
+                        self._idle.remove(preferred)
+                        return preferred
+                elif self._idle:
+                    owners = {}
+                    for worker in self._affinity.values():
+                        owners[worker] = owners.get(worker, 0) + 1
+                    worker = min(self._idle, key=lambda w: owners.get(w, 0))
+                    if owners.get(worker, 0) == 0 or self._count >= self.max_workers:
+                        self._idle.remove(worker)
+                        return worker
+                if preferred is None and self._count < self.max_workers:
+                    self._count += 1
+                    break
+                self._cond.wait()
+        try:
+            return _Worker(self._context)
+        except Exception:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify_all()
+            raise
+
+    def _release(self, session, worker, alive):
+        with self._cond:
+            if alive:
+                self._idle.append(worker)
+                self._affinity[session] = worker
+            else:
+                self._count -= 1
+                self._affinity = {s: w for s, w in self._affinity.items() if w is not worker}
+            # 等待者各自等待不同的子进程，需要全部唤醒重新判断
+            self._cond.notify_all()
+
+    def forget(self, session):
+        # 会话的变量空间不再使用，子进程中的旧变量空间随后按LRU淘汰
+        with self._cond:
+            self._affinity.pop(session, None)
+
+    def run(self, session, key, code):
+        worker = self._acquire(session)
+        try:
+            output = worker.run(session, key, code, self.timeout)
+        except TimeoutError as e:
+            worker.kill()
+            self._release(session, worker, False)
+            return f"TimeoutError: {str(e)}"
+        except (EOFError, OSError) as e:
+            # 子进程异常退出（如超过硬限制被系统终止）
+            worker.kill()
+            self._release(session, worker, False)
+            return f"RuntimeError: 代码执行进程异常退出 {str(e)}"
+        self._release(session, worker, True)
+        return output
+
+
+SANDBOX = SandboxPool(SANDBOX_WORKERS, SANDBOX_TIMEOUT)
+
+
+class SandboxPythonTool(BaseTool):
+    """与 PythonAstREPLTool 同名同描述，代码改在 SANDBOX 子进程中执行"""
+
+    name: str = PythonAstREPLTool.model_fields["name"].default
+    description: str = PythonAstREPLTool.model_fields["description"].default
+    args_schema: Type[PythonInputs] = PythonInputs
+    dataset_key: tuple
+    session: str = Field(default_factory=lambda: uuid.uuid4().hex)
+
+    def _run(self, query, run_manager=None):
+        return SANDBOX.run(self.session, self.dataset_key, query)
+
+    def new_session(self):
+        """换用新的变量空间，之前定义的变量和对 df 的修改都不再可见"""
+        SANDBOX.forget(self.session)
+        self.session = uuid.uuid4().hex
+
+
+def sandbox_tool(dataset_key):
+    """数据集已落盘时返回沙箱工具，否则返回None（调用方继续在进程内执行）"""
+    if SANDBOX_WORKERS <= 0 or dataset_key is None or dataset_key not in DATASET_STORE:
+        return None
+    return SandboxPythonTool(dataset_key=dataset_key)
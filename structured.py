@@ -0,0 +1,166 @@
+import json
+import re
+from typing import List, Optional, Type, Union
+
+from langchain_core.tools import BaseTool
+from pydantic import BaseModel, Field
+
+# 分析结果的四种结构，与 PROMPT_TEMPLATE 中的格式一致
+RESULT_KEYS = ("answer", "table", "bar", "line")
+SUBMIT_TOOL_NAME = "submit_result"
+
+_FENCE_RE = re.compile(r"```(?:json)?", re.IGNORECASE)
+_NUMBER_RE = re.compile(r"-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+_WORD_RE = re.compile(r"[^\W\d]\w*")
+_LITERALS = {"true": "true", "false": "false", "null": "null",
+             "True": "true", "False": "false", "None": "null", "NaN": "null", "nan": "null"}
+
+
+class TableResult(BaseModel):
+    columns: List[str] = Field(description="列名")
+    data: List[List[Union[str, float, int, bool, None]]] = Field(description="按行排列的数据，每行与 columns 一一对应")
+
+
+class SeriesResult(BaseModel):
+    columns: List[str] = Field(description="类别或X轴标签")
+    data: List[float] = Field(description="与 columns 一一对应的数值")
+
+
+class AnalysisResult(BaseModel):
+    """提交最终分析结果；answer、table、bar、line 四选一"""
+
+    answer: Optional[str] = Field(default=None, description="不超过50个字符的明确答案")
+    table: Optional[TableResult] = Field(default=None, description="表格数据")
+    bar: Optional[SeriesResult] = Field(default=None, description="柱状图数据")
+    line: Optional[SeriesResult] = Field(default=None, description="折线图数据")
+
+
+class SubmitResultTool(BaseTool):
+    """结构化输出工具：参数由模型按JSON Schema生成，直接作为智能体的最终输出（return_direct）"""
+
+    name: str = SUBMIT_TOOL_NAME
+    description: str = (
+        "Submit the final result of the analysis. Call this exactly once when you know the answer, "
+        "filling exactly one of: answer (short text), table, bar (bar chart) or line (line chart)."
+    )
+    args_schema: Type[BaseModel] = AnalysisResult
+    return_direct: bool = True
+
+    def _run(self, answer=None, table=None, bar=None, line=None, run_manager=None):
+        values = {"answer": answer, "table": table, "bar": bar, "line": line}
+        result = {key: value.model_dump() if isinstance(value, BaseModel) else value
+                  for key, value in values.items() if value is not None}
+        return json.dumps(result or {"answer": ""}, ensure_ascii=False)
+
+
+def _close_value(out):
+    # 截断在逗号或冒号之后时，去掉逗号或补一个 null
+    while out and out[-1].strip() in ("", ","):
+        out.pop()
+    if out and out[-1].strip() == ":":
+        out.append("null")
+
+
+def repair_json(text):
+    """逐字符修复模型输出的JSON：代码块标记、单引号、未加引号的键、Python字面量、多余逗号，
+    以及流式输出中途截断（未闭合的字符串和括号）。返回修复后的文本，没有JSON时返回None。
+    """
+    text = _FENCE_RE.sub("", text)
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        return None
+    out, stack = [], []
+    quote, escape = None, False
+    i = min(starts)
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if escape:
+                if ch == "'":
+                    # Python单引号字符串中的 \' 在JSON中不是合法转义，去掉反斜杠
+                    out.pop()
+                out.append(ch)
+                escape = False
+            elif ch == "\\":
+                out.append(ch)
+                escape = True
+            elif ch == quote:
+                out.append('"')
+                quote = None
+            elif ch == '"':
+                out.append('\\"')
+            elif ch in "\n\r\t":
+                out.append(json.dumps(ch)[1:-1])
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch in "\"'":
+            quote = ch
+            out.append('"')
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            _close_value(out)
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break
+        elif ch == "-" or ch.isdigit() or ch == ".":
+            match = _NUMBER_RE.match(text, i)
+            if match:
+                out.append(match.group(0))
+                i = match.end()
+                continue
+            out.append(ch)
+        elif ch.isalpha() or ch == "_":
+            word = _WORD_RE.match(text, i).group(0)
+            out.append(_LITERALS.get(word, json.dumps(word, ensure_ascii=False)))
+            i += len(word)
+            continue
+        else:
+            out.append(ch)
+        i += 1
+
+    if quote:
+        if escape:
+            out.pop()
+        out.append('"')
+    _close_value(out)
+    out.extend(reversed(stack))
+    return "".join(out)
+
+
+def parse_partial_json(text):
+    """宽松解析：先按标准JSON解析，失败后修复；仍失败时逐步丢弃末尾不完整的元素再试"""
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        pass
+    repaired = repair_json(text)
+    while repaired:
+        try:
+            return json.loads(repaired)
+        except ValueError:
+            cut = max(repaired.rfind(","), repaired.rfind("{"), repaired.rfind("["))
+            if cut <= 0:
+                return None
+            shorter = repair_json(repaired[:cut] if repaired[cut] == "," else repaired[:cut + 1])
+            # 补齐括号后可能与原文本相同，没有变短时停止，避免死循环
+            if shorter is None or len(shorter) >= len(repaired):
+                return None
+            repaired = shorter
+    return None
+
+
+def parse_result(output, strict=False):
+    """把智能体的最终输出解析为 {"answer"} / {"table"} / {"bar"} / {"line"}
+
+    无法解析时作为文字回答；strict 为真时返回None，调用方据此区分真正的结果和兜底文本。
+    """
+    value = parse_partial_json(output)
+    if isinstance(value, dict) and any(key in value for key in RESULT_KEYS):
+        return {key: value[key] for key in RESULT_KEYS if key in value}
+    return None if strict else {"answer": str(output).strip()}
@@ -0,0 +1,84 @@
+import pandas as pd
+import pytest
+
+from planner import plan_query
+
+# 明细数据：产品和地区有重复，5种产品、3个地区、7行
+SALES = pd.DataFrame({
+    "产品": ["A", "B", "A", "C", "D", "E", "B"],
+    "地区": ["东", "西", "东", "南", "西", "南", "东"],
+    "销售额": [50, 200, 150, 120, 80, 300, 90],
+    "成本": [5, 2, 3, 4, 6, 1, 7],
+})
+
+
+def _rows(result):
+    return result["table"]["data"]
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("地区的个数", "地区共有3种不同取值"),
+    ("产品数量", "产品共有5种不同取值"),
+    ("地区有多少种", "地区共有3种不同取值"),
+    ("一共有多少行", "共有7行数据"),
+    ("共有多少条记录", "共有7行数据"),
+    ("销售额的平均值是多少", "销售额的平均值为141.43"),
+    ("销售额总和", "销售额的总和为990"),
+    ("销售额的个数", "销售额的数量为7"),
+    ("成本最大值", "成本的最大值为7"),
+])
+def test_scalar_answers(query, expected):
+    assert plan_query(SALES, query) == {"answer": expected}
+
+
+@pytest.mark.parametrize("query, columns, rows", [
+    # 文本列的计数是不同取值的个数
+    ("各地区的产品数量", ["地区", "产品数量"], [["东", 2], ["南", 2], ["西", 2]]),
+    ("各地区数量", ["地区", "数量"], [["东", 3], ["南", 2], ["西", 2]]),
+    ("按地区统计销售额平均值", ["地区", "销售额平均值"], [["东", 96.67], ["南", 210.0], ["西", 140.0]]),
+    ("各地区销售额总和是多少", ["地区", "销售额总和"], [["东", 290], ["南", 420], ["西", 280]]),
+])
+def test_group_aggregates(query, columns, rows):
+    result = plan_query(SALES, query)
+    assert result["table"]["columns"] == columns
+    assert [[label, round(value, 2)] for label, value in _rows(result)] == rows
+
+
+@pytest.mark.parametrize("query, rows", [
+    ("销售额最高的3个产品", [["E", 300], ["B", 200], ["A", 150]]),
+    ("成本最低的2个产品", [["E", 1], ["B", 2]]),
+    # 只有出现求和词时才按产品汇总
+    ("销售额总和最高的2个产品", [["E", 300], ["B", 290]]),
+    ("销售额合计最低的1个地区", [["西", 280]]),
+])
+def test_top_n(query, rows):
+    assert _rows(plan_query(SALES, query)) == rows
+
+
+def test_head_rows():
+    assert _rows(plan_query(SALES, "前3行")) == SALES.head(3).values.tolist()
+
+
+@pytest.mark.parametrize("query, rows", [
+    ("销售额大于150的产品有哪些", [[200, "B"], [300, "E"]]),
+    ("产品为A的记录", [["A", "东", 50, 5], ["A", "东", 150, 3]]),
+])
+def test_filters(query, rows):
+    assert _rows(plan_query(SALES, query)) == rows
+
+
+@pytest.mark.parametrize("query", [
+    # 计数问题不能被当作筛选返回明细行
+    "销售额大于100的产品有多少个",
+    "产品是A的有几个",
+    # 前N行中产品重复（A出现两次），是否汇总不确定
+    "销售额最高的5个产品",
+    # 非可加指标的汇总、文本列的平均值、无法识别的问题都交给智能体
+    "销售额平均值最高的2个产品",
+    "地区的平均值",
+    "销售额有多少",
+    "销售额和成本的相关性",
+    "产品为Z的记录",
+])
+def test_falls_back_to_agent(query):
+    assert plan_query(SALES, query) is None
@@ -0,0 +1,29 @@
+import pytest
+
+from structured import parse_result
+
+
+@pytest.mark.parametrize("output, expected", [
+    ('{"answer": "共有3个地区"}', {"answer": "共有3个地区"}),
+    # Python字面量风格：单引号、转义的撇号、True/None
+    (r"{'answer': 'don\'t'}", {"answer": "don't"}),
+    (r"{'table': {'columns': ['name', 'vip'], 'data': [['O\'Neil', True], ['Li', None]]}}",
+     {"table": {"columns": ["name", "vip"], "data": [["O'Neil", True], ["Li", None]]}}),
+    # 代码块标记、多余逗号
+    ('```json\n{"bar": {"columns": ["A", "B"], "data": [1, 2],},}\n```',
+     {"bar": {"columns": ["A", "B"], "data": [1, 2]}}),
+    # 流式输出中途截断
+    ('{"line": {"columns": ["1月", "2月"], "data": [3.5, 4', {"line": {"columns": ["1月", "2月"], "data": [3.5, 4]}}),
+])
+def test_repairs_formatting_slips(output, expected):
+    assert parse_result(output, strict=True) == expected
+
+
+def test_plain_text_falls_back_to_answer():
+    assert parse_result("Agent stopped due to max iterations.", strict=True) is None
+    assert parse_result(" 没有找到数据 ") == {"answer": "没有找到数据"}
+
+
+def test_unrepairable_escape_terminates():
+    # 无法修复的转义不能让逐步截断的重试陷入死循环
+    assert parse_result(r'{"answer": "bad \q escape", "table": [[1, 2]]}', strict=True) is None
@@ -0,0 +1,239 @@
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 设为0时关闭追踪，span 只剩一次上下文变量读取的开销
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") != "0"
+# 追踪记录按行写入JSONL日志，超过大小后轮转，保留若干个历史文件
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", ".trace_log.jsonl")
+TRACE_LOG_MB = int(os.getenv("TRACE_LOG_MB", "10"))
+TRACE_LOG_BACKUPS = int(os.getenv("TRACE_LOG_BACKUPS", "5"))
+# 进程内保留的最近追踪条数，供侧边栏诊断面板展示
+TRACE_HISTORY = int(os.getenv("TRACE_HISTORY", "200"))
+
+_current = ContextVar("trace", default=None)
+_session = ContextVar("trace_session", default=None)
+_ids = itertools.count(1)
+
+# 参与命中率统计的缓存：名称 -> 带 hits / misses 计数的对象
+CACHES = {}
+
+
+def register_cache(name, cache):
+    CACHES[name] = cache
+    return cache
+
+
+def cache_stats():
+    return {name: (cache.hits, cache.misses) for name, cache in CACHES.items()}
+
+
+def max_rss_bytes():
+    # ru_maxrss 在Linux上以KB为单位，macOS上以字节为单位
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Trace:
+    """一次用户操作（加载、分析、图表、聊天）的追踪：总耗时、各阶段耗时和计数"""
+
+    def __init__(self, name, session=None, **attrs):
+        self.id = next(_ids)
+        self.name = name
+        self.session = session
+        self.attrs = attrs
+        self.spans = []
+        self.status = "ok"
+        self.error = None
+        self.started = time.time()
+        self.duration = None
+        self.resources = None
+        self._start = time.perf_counter()
+        self._cpu = time.thread_time()
+        self._caches = cache_stats()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, duration, cpu=None, **attrs):
+        # start 为 time.perf_counter() 的读数，记录时换算为相对追踪开始的偏移
+        with self._lock:
+            self.spans.append(dict(attrs, name=name, offset_ms=(start - self._start) * 1000,
+                                   duration_ms=duration * 1000,
+                                   cpu_ms=cpu * 1000 if cpu is not None else None))
+
+    def incr(self, key, n=1):
+        with self._lock:
+            self.attrs[key] = self.attrs.get(key, 0) + n
+
+    def finish(self, status="ok", error=None):
+        self.duration = time.perf_counter() - self._start
+        self.status, self.error = status, error
+        # 缓存计数是进程内共享的，并发时也会包含其他会话的命中
+        caches = {}
+        for name, (hits, misses) in cache_stats().items():
+            old_hits, old_misses = self._caches.get(name, (0, 0))
+            if (hits, misses) != (old_hits, old_misses):
+                caches[name] = {"hits": hits - old_hits, "misses": misses - old_misses}
+        rss = max_rss_bytes()
+        self.resources = {
+            "cpu_ms": (time.thread_time() - self._cpu) * 1000,
+            "max_rss_mb": rss / 1024 / 1024 if rss is not None else None,
+            "caches": caches,
+        }
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "trace": self.name,
+            "session": self.session,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+            "duration_ms": self.duration * 1000 if self.duration is not None else None,
+            "status": self.status,
+            "error": self.error,
+            "attrs": self.attrs,
+            "spans": list(self.spans),
+            "resources": self.resources,
+        }
+
+
+class TraceLog:
+    """保存最近的追踪记录，并追加写入按大小轮转的JSONL日志"""
+
+    def __init__(self, path, max_bytes, backups, history):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._recent = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._logger = None
+
+    def _get_logger(self):
+        # 第一次写入时才创建日志文件，只导入本模块的子进程不会产生空文件
+        if self._logger is None:
+            logger = logging.getLogger(f"tracing.{id(self)}")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups,
+                                          encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def record(self, trace):
+        record = trace.to_dict()
+        with self._lock:
+            self._recent.append(record)
+        if not self.path:
+            return
+        try:
+            self._get_logger().info(json.dumps(record, ensure_ascii=False, default=str))
+        except OSError as e:
+            print(f"Trace not logged: {str(e)}")
+
+    def recent(self, session=None, limit=None):
+        """最近的追踪记录，新的在前；指定 session 时只返回该会话的记录"""
+        with self._lock:
+            records = [r for r in reversed(self._recent) if session is None or r["session"] == session]
+        return records[:limit] if limit else records
+
+    def stage_summary(self, session=None):
+        """按 "追踪/阶段" 汇总次数和耗时分位数，返回按总耗时从高到低排列的列表"""
+        durations = {}
+        for record in self.recent(session):
+            if record["duration_ms"] is not None:
+                durations.setdefault(record["trace"], []).append(record["duration_ms"])
+            for item in record["spans"]:
+                durations.setdefault(f"{record['trace']}/{item['name']}", []).append(item["duration_ms"])
+        summary = [{
+            "stage": stage,
+            "count": len(values),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+            "total_ms": float(np.sum(values)),
+        } for stage, values in durations.items()]
+        return sorted(summary, key=lambda item: item["total_ms"], reverse=True)
+
+
+TRACE_LOG = TraceLog(TRACE_LOG_PATH, TRACE_LOG_MB * 1024 * 1024, TRACE_LOG_BACKUPS, TRACE_HISTORY)
+
+
+def bind_session(session_id):
+    """把当前线程（上下文）之后开始的追踪归属到某个会话"""
+    _session.set(session_id)
+
+
+def current_trace():
+    return _current.get()
+
+
+def _reset(token, previous):
+    # 生成器中途被关闭时可能在另一个上下文中退出，此时直接恢复原值
+    try:
+        _current.reset(token)
+    except ValueError:
+        _current.set(previous)
+
+
+@contextmanager
+def trace(name, **attrs):
+    """开始一次追踪，返回可以继续写入的属性字典
+
+    已经处于追踪中时只作为其中的一个阶段记录，因此既可以在页面中调用，也可以在后台任务中直接调用。
+    """
+    parent = _current.get()
+    if parent is not None or not TRACE_ENABLED:
+        with span(name, **attrs) as values:
+            yield values
+        return
+
+    current = Trace(name, _session.get(), **attrs)
+    token = _current.set(current)
+    status, error = "ok", None
+    try:
+        yield current.attrs
+    except GeneratorExit:
+        status = "cancelled"
+        raise
+    except BaseException as e:
+        # Streamlit 的停止/重跑也是通过异常中断脚本
+        status, error = ("cancelled", None) if type(e).__module__.startswith("streamlit") else ("error", repr(e))
+        raise
+    finally:
+        _reset(token, parent)
+        current.finish(status, error)
+        TRACE_LOG.record(current)
+
+
+@contextmanager
+def span(name, **attrs):
+    """记录当前追踪中的一个阶段（耗时和线程CPU时间）；不在追踪中时不做任何记录"""
+    current = _current.get()
+    if current is None:
+        yield attrs
+        return
+    start, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.add_span(name, start, time.perf_counter() - start, time.thread_time() - cpu, **attrs)
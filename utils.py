@@ -1,60 +1,572 @@
-import json
-from langchain_openai import ChatOpenAI
-from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
-
-PROMPT_TEMPLATE = """你是一位数据分析助手，你的回应内容取决于用户的请求内容，请按照下面的步骤处理用户请求：
-
-1. 思考阶段 (Thought) ：先分析用户请求类型（文字回答/表格/图表），并验证数据类型是否匹配。
-2. 行动阶段 (Action) ：根据分析结果选择以下严格对应的格式。
-   - 纯文字回答: 
-     {"answer": "不超过50个字符的明确答案"}
-
-   - 表格数据：  
-     {"table":{"columns":["列名1", "列名2", ...], "data":[["第一行值1", "值2", ...], ["第二行值1", "值2", ...]]}}
-
-   - 柱状图 
-     {"bar":{"columns": ["A", "B", "C", ...], "data":[35, 42, 29, ...]}}
-
-   - 折线图 
-     {"line":{"columns": ["A", "B", "C", ...], "data": [35, 42, 29, ...]}}
-
-3. 格式校验要求
-   - 字符串值必须使用英文双引号
-   - 数值类型不得添加引号
-   - 确保数组闭合无遗漏
-
-   错误案例：{'columns':['Product', 'Sales'], data:[[A001, 200]]}  
-   正确案例：{"columns":["product", "sales"], "data":[["A001", 200]]}
-
-注意：响应数据的"output"中不要有换行符、制表符以及其他格式符号。
-
-当前用户请求："""
-
-
-def dataframe_agent(df, query):
-    try:
-        # 直接传递API密钥（仅用于开发和测试）
-        model = ChatOpenAI(
-            model="gpt-4o-mini",  # 或者使用"gpt-4"如果你有访问权限
-            temperature=0,
-            openai_api_key="hk-j62h2y1000055562ac31c59fece0175052cb617eef8352e4",  # 替换为你的实际API密钥
-            openai_api_base="https://twapi.openai-hk.com/v1"  # 默认使用OpenAI官方API
-        )
-
-        agent = create_pandas_dataframe_agent(
-            llm=model,
-            df=df,
-            agent_executor_kwargs={"handle_parsing_errors": True},
-            max_iterations=10,
-            early_stopping_method='generate',
-            allow_dangerous_code=True,
-            verbose=True
-        )
-
-        prompt = PROMPT_TEMPLATE + query
-        response = agent.invoke({"input": prompt})
-        return json.loads(response["output"])
-
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-        raise
\ No newline at end of file
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import httpx
+import pandas as pd
+from langchain.agents import AgentExecutor, create_openai_tools_agent, create_react_agent
+from langchain.agents.agent import RunnableAgent, RunnableMultiActionAgent
+from langchain.agents.mrkl.prompt import FORMAT_INSTRUCTIONS
+from langchain.chains.conversation.prompt import PROMPT as CONVERSATION_PROMPT
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain_openai import ChatOpenAI
+from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
+from langchain_experimental.tools.python.tool import PythonAstREPLTool
+
+from duckdb_backend import DuckDBQueryTool, DuckTable
+from planner import PLANNER_STATS, plan_query
+from profiling import cached_profile, format_profile
+from sandbox import SandboxPythonTool, sandbox_tool
+from structured import SUBMIT_TOOL_NAME, SubmitResultTool, parse_result
+from tracing import current_trace, register_cache, span, trace
+
+PROMPT_TEMPLATE = """你是一位数据分析助手，你的回应内容取决于用户的请求内容，请按照下面的步骤处理用户请求：
+
+1. 思考阶段 (Thought) ：先分析用户请求类型（文字回答/表格/图表），并验证数据类型是否匹配。
+2. 行动阶段 (Action) ：根据分析结果选择以下严格对应的格式。
+   - 纯文字回答: 
+     {"answer": "不超过50个字符的明确答案"}
+
+   - 表格数据：  
+     {"table":{"columns":["列名1", "列名2", ...], "data":[["第一行值1", "值2", ...], ["第二行值1", "值2", ...]]}}
+
+   - 柱状图 
+     {"bar":{"columns": ["A", "B", "C", ...], "data":[35, 42, 29, ...]}}
+
+   - 折线图 
+     {"line":{"columns": ["A", "B", "C", ...], "data": [35, 42, 29, ...]}}
+
+3. 格式校验要求
+   - 字符串值必须使用英文双引号
+   - 数值类型不得添加引号
+   - 确保数组闭合无遗漏
+
+   错误案例：{'columns':['Product', 'Sales'], data:[[A001, 200]]}  
+   正确案例：{"columns":["product", "sales"], "data":[["A001", 200]]}
+
+注意：响应数据的"output"中不要有换行符、制表符以及其他格式符号。
+
+{profile}当前用户请求："""
+
+# 结构化输出模式下附加在提示词末尾的说明
+STRUCTURED_NOTE = "（完成分析后调用 submit_result 工具提交结果，字段与上面的格式相同，不要直接回复JSON文本）"
+
+# 预先统计的数据集概况，插入到 PROMPT_TEMPLATE 的 {profile} 处
+PROFILE_SECTION = """数据集概况（已预先统计，无需再调用 df.head()、df.dtypes、df.describe() 等查看数据结构）：
+{profile}
+
+"""
+
+# DuckDB引擎的SQL智能体提示词（ReAct格式，与pandas智能体相同）
+SQL_AGENT_PREFIX = """You are working with a DuckDB table named `data`.
+The table is too large to load into memory, so answer questions by running SQL queries on it.
+Always aggregate, filter or use LIMIT inside SQL instead of selecting raw rows.
+The columns, types and sample rows of the table are given in the question."""
+
+SQL_AGENT_TOOLS = "You should use the tools below to answer the question posed of you:"
+
+SQL_AGENT_SUFFIX = """Begin!
+Question: {input}
+{agent_scratchpad}"""
+
+# 分析智能体使用的模型参数，同时作为结果缓存键的一部分
+# agent_type 为 "openai-tools" 时使用工具调用提交结构化结果；接口不支持工具调用时可设为 "zero-shot-react-description"
+MODEL_SETTINGS = {"model": "gpt-4o-mini", "temperature": 0, "max_iterations": 10,
+                  "agent_type": os.getenv("AGENT_TYPE", "openai-tools")}
+
+# OpenAI兼容接口地址；测试和基准测试时可指向本地的 mock_server.py
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://twapi.openai-hk.com/v1")
+# 直接传递API密钥（仅用于开发和测试）
+AGENT_API_KEY = "hk-j62h2y1000055562ac31c59fece0175052cb617eef8352e4"
+
+# 每个 (api_key, base_url) 的keep-alive连接池大小；每个数据集最多保留的空闲智能体数和数据集数
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+AGENT_POOL_IDLE = int(os.getenv("AGENT_POOL_IDLE", "4"))
+AGENT_POOL_DATASETS = int(os.getenv("AGENT_POOL_DATASETS", "16"))
+
+# 聊天记忆的默认token预算
+CHAT_MEMORY_TOKENS = int(os.getenv("CHAT_MEMORY_TOKENS", "2000"))
+
+# 分析结果缓存：本地SQLite文件，过期时间（秒）和容量上限（MB）
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH", ".query_cache.sqlite3")
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", str(7 * 24 * 3600)))
+QUERY_CACHE_MB = int(os.getenv("QUERY_CACHE_MB", "64"))
+
+
+def normalize_query(query):
+    # 全角/半角统一、合并空白、去掉句末标点，使措辞相同的问题得到同一个键
+    query = unicodedata.normalize("NFKC", query).strip().lower()
+    query = re.sub(r"\s+", " ", query)
+    return query.rstrip("。.？?！!；; ")
+
+
+def dataframe_fingerprint(df):
+    """按内容计算DataFrame指纹；调用方已知数据集键时应直接传入以省去整表哈希"""
+    if isinstance(df, DuckTable):
+        return repr(df.key)
+    digest = hashlib.sha256()
+    digest.update(repr(list(zip(df.columns, df.dtypes.astype(str)))).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def query_cache_key(fingerprint, query, settings=MODEL_SETTINGS):
+    payload = json.dumps([fingerprint, normalize_query(query), settings,
+                          hashlib.sha256(PROMPT_TEMPLATE.encode()).hexdigest()],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class QueryResultCache:
+    """分析结果的本地持久化缓存：按过期时间失效，超过容量时淘汰最久未访问的记录"""
+
+    def __init__(self, path, ttl, max_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        text = json.dumps(value, ensure_ascii=False)
+        size = len(text.encode())
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (key, text, size, now, now))
+            conn.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total > self.max_bytes:
+                # 按最近访问时间从旧到新淘汰，直到回到容量以内
+                for old_key, old_size in conn.execute("SELECT key, size FROM results ORDER BY accessed").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                    total -= old_size
+        return value
+
+
+QUERY_CACHE = register_cache("query", QueryResultCache(QUERY_CACHE_PATH, QUERY_CACHE_TTL,
+                                                      QUERY_CACHE_MB * 1024 * 1024))
+
+
+_http_clients = {}
+_chat_models = {}
+_clients_lock = threading.Lock()
+
+
+def _http_clients_for(api_key, base_url):
+    # 同一个接口地址和密钥共享一组keep-alive连接，避免每次请求都重新握手
+    key = (api_key, base_url)
+    if key not in _http_clients:
+        limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE,
+                              keepalive_expiry=120)
+        timeout = httpx.Timeout(120, connect=10)
+        _http_clients[key] = (httpx.Client(limits=limits, timeout=timeout),
+                              httpx.AsyncClient(limits=limits, timeout=timeout))
+    return _http_clients[key]
+
+
+def get_chat_model(api_key, base_url=OPENAI_BASE_URL, model="gpt-4", **kwargs):
+    """返回共享的ChatOpenAI实例（线程安全，可在多个会话之间复用）"""
+    key = (api_key, base_url, model, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        if key not in _chat_models:
+            http_client, http_async_client = _http_clients_for(api_key, base_url)
+            _chat_models[key] = ChatOpenAI(
+                model=model,
+                api_key=api_key,
+                base_url=base_url,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                **kwargs
+            )
+        return _chat_models[key]
+
+
+class AgentPool:
+    """按数据集指纹复用已构建的pandas智能体
+
+    智能体的Python工具带有自己的变量空间，不能被两个请求同时使用，因此每个数据集维护一组空闲实例：
+    借出时优先复用空闲实例，没有空闲实例才新建；数据集数量超过上限时淘汰最久未使用的。
+    复用的实例在借出前重置变量空间，上一个查询的变量和对 df 的修改不会影响下一个查询。
+    """
+
+    def __init__(self, max_idle, max_datasets):
+        self.max_idle = max_idle
+        self.max_datasets = max_datasets
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, fingerprint, df, settings=MODEL_SETTINGS, dataset_key=None):
+        key = (fingerprint, json.dumps(settings, sort_keys=True))
+        with self._lock:
+            idle = self._idle.get(key)
+            agent = idle.pop() if idle else None
+            if key in self._idle:
+                self._idle.move_to_end(key)
+        if agent is None:
+            with span("agent.build"):
+                agent = self._build(df, settings, dataset_key)
+        else:
+            self._reset(agent, df)
+        try:
+            yield agent
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(agent)
+                self._idle.move_to_end(key)
+                while len(self._idle) > self.max_datasets:
+                    self._idle.popitem(last=False)
+
+    @staticmethod
+    def _reset(agent, df):
+        for tool in getattr(agent, "tools", []):
+            if isinstance(tool, PythonAstREPLTool):
+                tool.globals = {}
+                tool.locals = {"df": df.copy(deep=False)}
+            elif isinstance(tool, SandboxPythonTool):
+                tool.new_session()
+
+    def _build(self, df, settings, dataset_key=None):
+        model = get_chat_model(AGENT_API_KEY, settings.get("base_url", OPENAI_BASE_URL), settings["model"],
+                               temperature=settings["temperature"])
+        if isinstance(df, DuckTable):
+            return self._build_sql(model, df, settings)
+        structured = is_structured(settings)
+        agent = create_pandas_dataframe_agent(
+            llm=model,
+            # 生成的代码可能修改 df，智能体拿到的是写时复制的浅拷贝，不会改动各会话共享的数据集
+            df=df.copy(deep=False),
+            agent_type=settings["agent_type"],
+            # 结构化输出模式下由 submit_result 工具给出最终结果，工具调用不会出现文本解析错误
+            extra_tools=[SubmitResultTool()] if structured else [],
+            agent_executor_kwargs={} if structured else {"handle_parsing_errors": True},
+            # 数据结构和样例行已经包含在概况中，不再重复放入智能体提示词
+            include_df_in_prompt=False,
+            # 工具调用模式的提示词会直接拼接 suffix，需要显式传空字符串
+            **({"suffix": ""} if structured else {}),
+            max_iterations=settings["max_iterations"],
+            early_stopping_method='force' if structured else 'generate',
+            allow_dangerous_code=True,
+            verbose=True
+        )
+        # 数据集已落盘时，生成的代码改到沙箱子进程中执行，带CPU/内存/超时限制
+        tool = sandbox_tool(dataset_key)
+        if tool is not None:
+            agent.tools = [tool if t.name == tool.name else t for t in agent.tools]
+        return agent
+
+    def _build_sql(self, model, table, settings):
+        # DuckDB引擎：用SQL工具代替Python工具，数据始终留在磁盘上
+        tools = [DuckDBQueryTool(path=table.path, key=table.key)]
+        if is_structured(settings):
+            tools.append(SubmitResultTool())
+            prompt = ChatPromptTemplate.from_messages([
+                ("system", SQL_AGENT_PREFIX),
+                ("human", "{input}"),
+                MessagesPlaceholder("agent_scratchpad"),
+            ])
+            agent = RunnableMultiActionAgent(
+                runnable=create_openai_tools_agent(model, tools, prompt),
+                input_keys_arg=["input"],
+                return_keys_arg=["output"],
+            )
+            return AgentExecutor(
+                agent=agent,
+                tools=tools,
+                max_iterations=settings["max_iterations"],
+                early_stopping_method='force',
+                verbose=True
+            )
+
+        template = "\n\n".join([SQL_AGENT_PREFIX, SQL_AGENT_TOOLS, "{tools}", FORMAT_INSTRUCTIONS, SQL_AGENT_SUFFIX])
+        prompt = PromptTemplate.from_template(template)
+        agent = RunnableAgent(
+            runnable=create_react_agent(model, tools, prompt),
+            input_keys_arg=["input"],
+            return_keys_arg=["output"],
+        )
+        return AgentExecutor(
+            agent=agent,
+            tools=tools,
+            handle_parsing_errors=True,
+            max_iterations=settings["max_iterations"],
+            early_stopping_method='generate',
+            verbose=True
+        )
+
+
+AGENT_POOL = AgentPool(AGENT_POOL_IDLE, AGENT_POOL_DATASETS)
+
+
+def count_tokens(model, text):
+    # 无法加载tiktoken编码（如离线环境）时按UTF-8字节数粗略估算
+    try:
+        return model.get_num_tokens(text)
+    except Exception:
+        return max(1, len(text.encode("utf-8")) // 3)
+
+
+class TokenBudgetMemory(ConversationSummaryBufferMemory):
+    """有token预算的对话记忆：最近的消息原样保留，超出预算的早期消息增量合并进已有摘要"""
+
+    def _buffer_tokens(self, messages):
+        return sum(count_tokens(self.llm, f"{m.type}: {m.content}") for m in messages)
+
+    def prune(self):
+        buffer = self.chat_memory.messages
+        if self._buffer_tokens(buffer) <= self.max_token_limit:
+            return
+        pruned = []
+        while buffer and self._buffer_tokens(buffer) > self.max_token_limit:
+            pruned.append(buffer.pop(0))
+        self.moving_summary_buffer = self.predict_new_summary(pruned, self.moving_summary_buffer)
+
+
+def build_chat_memory(summary_llm, max_token_limit=CHAT_MEMORY_TOKENS):
+    return TokenBudgetMemory(llm=summary_llm, max_token_limit=max_token_limit)
+
+
+def stream_chat_reply(model, memory, prompt, usage=None):
+    """逐段产出聊天回复；与 ConversationChain 使用相同的提示词和记忆
+
+    生成结束或被中途停止（生成器被关闭）时，把已经生成的内容写入记忆。
+    传入 usage 列表时，每轮追加 {"prompt_tokens", "completion_tokens"}。
+    """
+    with trace("chat", model=model.model_name) as attrs:
+        with span("memory.load"):
+            history = memory.load_memory_variables({})["history"]
+        prompt_text = CONVERSATION_PROMPT.format(history=history, input=prompt)
+        parts = []
+        start = time.perf_counter()
+        try:
+            for chunk in model.stream(prompt_text):
+                if chunk.content:
+                    if not parts:
+                        attrs["first_token_ms"] = (time.perf_counter() - start) * 1000
+                    parts.append(chunk.content)
+                    yield chunk.content
+        finally:
+            if parts:
+                response = "".join(parts)
+                tokens = {"prompt_tokens": count_tokens(model, prompt_text),
+                          "completion_tokens": count_tokens(model, response)}
+                attrs.update(tokens)
+                if usage is not None:
+                    usage.append(tokens)
+                # 超出预算时会调用摘要模型，单独记录
+                with span("memory.save"):
+                    memory.save_context({"input": prompt}, {"response": response})
+
+
+def is_structured(settings=MODEL_SETTINGS):
+    return settings.get("agent_type") == "openai-tools"
+
+
+def build_agent_prompt(query, profile=None, structured=False):
+    section = PROFILE_SECTION.format(profile=format_profile(profile)) if profile else ""
+    return PROMPT_TEMPLATE.replace("{profile}", section) + query + (STRUCTURED_NOTE if structured else "")
+
+
+def _action_event(action):
+    # ReAct智能体的思考写在 log 的 Action 之前；工具调用智能体的思考是模型消息的文本内容
+    message_log = getattr(action, "message_log", None)
+    thought = message_log[-1].content if message_log else action.log.split("Action:")[0]
+    tool_input = action.tool_input
+    if isinstance(tool_input, dict) and len(tool_input) == 1:
+        tool_input = next(iter(tool_input.values()))
+    return {"type": "action", "tool": action.tool, "input": tool_input, "log": action.log,
+            "thought": str(thought).strip()}
+
+
+class AgentTraceHandler(BaseCallbackHandler):
+    """把智能体的每次模型调用和工具执行记录为追踪中的阶段，并累计调用次数和token数
+
+    流式调用时接口通常不返回用量，此时按 count_tokens 估算，并在阶段中标记 estimated。
+    """
+
+    def __init__(self, trace, model):
+        self.trace = trace
+        self.model = model
+        self._started = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        text = "\n".join(str(m.content) for batch in messages for m in batch)
+        self._started[run_id] = (time.perf_counter(), text)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = (time.perf_counter(), "\n".join(prompts))
+
+    def _usage(self, response, prompt_text):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage.get("prompt_tokens"):
+            return usage["prompt_tokens"], usage.get("completion_tokens", 0), False
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        message = getattr(generation, "message", None)
+        metadata = getattr(message, "usage_metadata", None)
+        if metadata:
+            return metadata["input_tokens"], metadata["output_tokens"], False
+        # 工具调用的参数也计入输出
+        completion = generation.text if generation else ""
+        for call in getattr(message, "tool_calls", None) or []:
+            completion += json.dumps(call["args"], ensure_ascii=False)
+        return count_tokens(self.model, prompt_text), count_tokens(self.model, completion or " "), True
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start, prompt_text = self._started.pop(run_id, (None, ""))
+        prompt_tokens, completion_tokens, estimated = self._usage(response, prompt_text)
+        self.trace.incr("llm_calls")
+        self.trace.incr("prompt_tokens", prompt_tokens)
+        self.trace.incr("completion_tokens", completion_tokens)
+        if start is not None:
+            self.trace.add_span("llm", start, time.perf_counter() - start, prompt_tokens=prompt_tokens,
+                                completion_tokens=completion_tokens, estimated=estimated)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        start, _ = self._started.pop(run_id, (None, ""))
+        if start is not None:
+            self.trace.add_span("llm", start, time.perf_counter() - start, error=type(error).__name__)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._started[run_id] = (time.perf_counter(), (serialized or {}).get("name", "tool"))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        start, name = self._started.pop(run_id, (None, "tool"))
+        if start is not None and name != SUBMIT_TOOL_NAME:
+            self.trace.add_span(f"tool.{name}", start, time.perf_counter() - start)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        start, name = self._started.pop(run_id, (None, "tool"))
+        if start is not None:
+            self.trace.add_span(f"tool.{name}", start, time.perf_counter() - start, error=type(error).__name__)
+
+
+def _data_bytes(df):
+    # DataFrame取加载时记录的内存占用（不再做深度统计），DuckDB表取磁盘上的文件大小
+    if isinstance(df, DuckTable):
+        return df.nbytes
+    return (df.attrs.get("memory_report") or {}).get("after")
+
+
+def agent_settings(base_url=None):
+    # 接口地址也是缓存键的一部分，本地模拟接口的结果不会混入真实结果
+    return dict(MODEL_SETTINGS, base_url=base_url or OPENAI_BASE_URL)
+
+
+def stream_dataframe_agent(df, query, fingerprint=None, dataset_key=None, base_url=None):
+    """逐步产出分析过程中的事件，最后一个事件是结果
+
+    事件格式：
+        {"type": "action", "tool": ..., "input": ..., "log": ...}   智能体的思考和工具调用
+        {"type": "observation", "output": ...}                     工具执行结果
+        {"type": "result", "result": {...}, "source": "cache" | "planner" | "agent"}
+
+    传入 dataset_key 且数据集已落盘时，智能体的代码在沙箱子进程中执行。
+    df 为 DuckTable 时由SQL智能体在DuckDB中查询。
+    """
+    settings = agent_settings(base_url)
+    engine = "duckdb" if isinstance(df, DuckTable) else "pandas"
+    with trace("analysis", engine=engine, model=settings["model"], agent_type=settings["agent_type"],
+               df_bytes=_data_bytes(df)) as attrs:
+        # 相同数据、相同问题和相同模型参数直接返回缓存结果，不调用模型
+        if fingerprint is None:
+            with span("fingerprint"):
+                fingerprint = dataframe_fingerprint(df)
+        cache_key = query_cache_key(fingerprint, query, settings)
+        with span("query_cache"):
+            cached = QUERY_CACHE.get(cache_key)
+        if cached is not None:
+            attrs["source"] = "cache"
+            yield {"type": "result", "result": cached, "source": "cache"}
+            return
+
+        # 常见的排名/分组/筛选/计数问题直接用pandas计算，不调用模型（DuckDB表不走快速通道）
+        with span("planner"):
+            planned = plan_query(df, query, dataset_key) if isinstance(df, pd.DataFrame) else None
+        PLANNER_STATS.record(planned is not None)
+        if planned is not None:
+            attrs["source"] = "planner"
+            yield {"type": "result", "result": planned, "source": "planner"}
+            return
+
+        # 同一数据集复用已构建的智能体和共享的模型连接
+        attrs["source"] = "agent"
+        with AGENT_POOL.acquire(fingerprint, df, settings, dataset_key) as agent:
+            prompt = build_agent_prompt(query, cached_profile(dataset_key or fingerprint, df), is_structured(settings))
+            current = current_trace()
+            config = {}
+            if current is not None:
+                model = get_chat_model(AGENT_API_KEY, settings["base_url"], settings["model"],
+                                       temperature=settings["temperature"])
+                config["callbacks"] = [AgentTraceHandler(current, model)]
+            structured = is_structured(settings)
+            tool_calls, submitted = 0, False
+            for chunk in agent.stream({"input": prompt}, config=config):
+                # submit_result 的调用就是最终结果，不作为中间步骤展示
+                if chunk.get("actions"):
+                    attrs["iterations"] = attrs.get("iterations", 0) + 1
+                for action in chunk.get("actions", []):
+                    if action.tool != SUBMIT_TOOL_NAME:
+                        tool_calls += 1
+                        yield _action_event(action)
+                for step in chunk.get("steps", []):
+                    if step.action.tool == SUBMIT_TOOL_NAME:
+                        submitted = True
+                    else:
+                        yield {"type": "observation", "output": step.observation}
+                if "output" in chunk:
+                    # 输出格式有误时宽松修复，不再因为一个引号或逗号让整个分析失败
+                    with span("parse_result", chars=len(str(chunk["output"]))):
+                        result = parse_result(chunk["output"], strict=True)
+                    # 只缓存正常结束并解析出结构化结果的输出：结构化模式要求来自 submit_result，
+                    # 文本模式要求未达到步数上限；提前停止的说明文字和无法解析的文本只展示不缓存
+                    finished = submitted if structured else tool_calls < agent.max_iterations
+                    if result is not None and finished:
+                        QUERY_CACHE.put(cache_key, result)
+                    yield {"type": "result", "result": result or parse_result(chunk["output"]),
+                           "source": "agent"}
+
+
+def dataframe_agent(df, query, fingerprint=None, dataset_key=None, base_url=None):
+    try:
+        result = None
+        for event in stream_dataframe_agent(df, query, fingerprint, dataset_key, base_url):
+            if event["type"] == "result":
+                result = event["result"]
+        return result
+
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        raise